@@ -1,3 +1,6 @@
+import os
+import hashlib
+import numpy as np
 import torch
 from torch import nn
 from torchvision.models import vit_b_32
@@ -31,6 +34,113 @@ class Vit_neck(nn.Module):
 
         return x
     
+class VitCache():
+    """
+    Content addressed disk cache of the Vit_neck features (50x768 tokens).
+    The key of a frame is the hash of the frame and of the encoder weights,
+    the features are saved as float16 .npy files and the least recently used
+    ones are deleted when the cache grows over max_bytes.
+    Call it as the model: features = cache(frames).
+    """
+
+    def __init__(self, model, cache_dir="data/vit_cache", max_bytes=20 * 2**30) -> None:
+        self.model = model
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.model_hash = self.hash_model(model)
+        self.hits = 0
+        self.misses = 0
+        self.size = sum(entry.stat().st_size for entry in self.entries())
+
+    def hash_model(self, model):
+        """
+        Hash of the weights of the encoder.
+        """
+        sha = hashlib.sha1()
+        for name, value in model.state_dict().items():
+            sha.update(name.encode())
+            sha.update(value.detach().cpu().contiguous().numpy().tobytes())
+        return sha.hexdigest()
+
+    def key(self, frame):
+        sha = hashlib.sha1(self.model_hash.encode())
+        sha.update(str((tuple(frame.shape), str(frame.dtype))).encode())
+        sha.update(frame.numpy().tobytes())
+        return sha.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def entries(self):
+        for folder in os.scandir(self.cache_dir):
+            if folder.is_dir():
+                yield from (entry for entry in os.scandir(folder.path) if entry.name.endswith(".npy"))
+
+    def load(self, key):
+        path = self.path(key)
+        try:
+            features = np.load(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        # Mark as recently used
+        os.utime(path)
+        return features
+
+    def save(self, key, features):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write in a temporary file, so a reader never sees a partial file
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, features)
+        os.replace(temp_path, path)
+        self.size += os.path.getsize(path)
+
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used features until the cache uses 90% of max_bytes.
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry.stat().st_mtime)
+        self.size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.size -= size
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0., "size": self.size}
+
+    def __call__(self, x) -> torch.Tensor:
+        frames = x.detach().cpu().contiguous()
+        keys = [self.key(frame) for frame in frames]
+
+        features = [self.load(key) for key in keys]
+        missing = [i for i, f in enumerate(features) if f is None]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        ## Run the encoder only in the frames not present in the cache
+        if missing:
+            with torch.no_grad():
+                out = self.model(x[missing]).to(torch.float16).cpu().numpy()
+            for i, f in zip(missing, out):
+                self.save(keys[i], f)
+                features[i] = f
+
+        # The features have the float16 precision of the cache for hits and misses
+        return torch.from_numpy(np.stack(features)).to(device=x.device, dtype=torch.float32)
+
 if __name__ == '__main__':
     image_size = 224
     batch_size = 16
@@ -0,0 +1,312 @@
+"""
+Micro benchmarks of the project, each benchmark is a sub command:
+
+python benchmark.py sampling --device cuda --batch_size 50
+python benchmark.py dataloader --dataroot ./data/train/DAVIS --output loader_config.json
+python benchmark.py train_step --device cpu --precisions fp32,bf16
+python benchmark.py checkpointing --device cuda --batch_size 32
+python benchmark.py attention --device cuda --size 28 --channels 200
+"""
+import argparse
+import copy
+import itertools
+import json
+import random
+import time
+
+import torch
+from torch.utils.data import DataLoader, default_collate
+
+import read_data as ld
+from ddpm import Diffusion
+from modules import EMA, SelfAttention, UNet_conditional
+
+def sync(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize()
+
+def reset_peak_memory(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+
+def peak_memory(device):
+    """
+    Peak of allocated memory in MiB (only measured on cuda).
+    """
+    if str(device).startswith("cuda"):
+        return torch.cuda.max_memory_allocated() / 2**20
+    return float("nan")
+
+def timeit(fn, device, repeat=1):
+    """
+    Return the mean time (s) of fn and the peak memory (MiB) of the calls.
+    """
+    reset_peak_memory(device)
+    sync(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    sync(device)
+    return (time.perf_counter() - start) / repeat, peak_memory(device)
+
+def create_model(args, **kwargs):
+    return UNet_conditional(c_in=4, c_out=4, time_dim=args.time_dim, img_size=args.image_size//8, net_dimension=args.net_dimension, device=args.device, **kwargs).to(args.device)
+
+def bench_sampling(args):
+    """
+    Latency per step and peak memory of Diffusion.sample, with and without
+    the precomputed time embeddings and conditioning (cache_inference).
+    """
+    model = create_model(args)
+    diffusion = Diffusion(img_size=args.image_size//8, device=args.device, noise_steps=args.noise_steps)
+    labels = torch.randn(args.batch_size, 50, 768, device=args.device)
+
+    for cache_inference in (False, True):
+        diffusion.cache_inference = cache_inference
+        sample = lambda steps: diffusion.sample(model, labels=labels, in_ch=4, create_img=False, sampler=args.sampler, steps=steps, cfg_scale=args.cfg_scale)
+
+        # Warm up
+        sample(2)
+        elapsed, memory = timeit(lambda: sample(args.steps), args.device)
+        print(f"cache_inference={cache_inference}: {1000 * elapsed / args.steps:.2f} ms/step, peak memory {memory:.1f} MiB")
+
+def create_dataset(args):
+    if args.latents:
+        return ld.ReadLatent(file_name=args.file_name).create_dataset(args.dataroot)
+    if ld.is_frame_pack(args.dataroot):
+        return ld.FramePackDataset(args.dataroot, args.image_size, train=args.train)
+    return ld.ColorizationDataset(args.dataroot, args.image_size, train=args.train, cache_size=args.cache_size)
+
+def stage_times(dataset, n):
+    """
+    Mean time (ms per sample) of each stage of the loading, in the main process.
+    """
+    indices = random.sample(range(len(dataset)), min(n, len(dataset)))
+    times = {}
+
+    ## Decode and transform of the frames
+    if isinstance(dataset, ld.ColorizationDataset):
+        paths = [dataset.dataset.samples[i][0] for i in indices]
+        start = time.perf_counter()
+        frames = [dataset.__decode__(path) for path in paths]
+        times["decode"] = time.perf_counter() - start
+        start = time.perf_counter()
+        [dataset.__transform__(frame) for frame in frames]
+        times["transform"] = time.perf_counter() - start
+    elif isinstance(dataset, ld.FramePackDataset):
+        start = time.perf_counter()
+        [dataset.pack[i].copy() for i in indices]
+        times["decode"] = time.perf_counter() - start
+        start = time.perf_counter()
+        [dataset.frame(i) for i in indices]
+        times["transform"] = time.perf_counter() - start - times["decode"]
+
+    ## A full item (for frames, the frame, keyframe and next frame)
+    start = time.perf_counter()
+    items = [dataset[i] for i in indices]
+    times["item"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    default_collate(items)
+    times["collate"] = time.perf_counter() - start
+
+    return {stage: 1000 * t / len(indices) for stage, t in times.items()}
+
+def loader_throughput(dataset, batch_size, loader_config, batches):
+    """
+    Samples per second of a DataLoader (after the first batch, that starts the workers).
+    """
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, **ld.loader_kwargs(loader_config))
+    data_iter = iter(dataloader)
+    next(data_iter)
+
+    ## Samples of each batch from the sampler (the batches of the image datasets are nested lists)
+    samples = 0
+    start = time.perf_counter()
+    for i, _ in enumerate(itertools.islice(data_iter, batches), start=1):
+        samples += min(batch_size, len(dataset) - i * batch_size)
+    elapsed = time.perf_counter() - start
+    del data_iter
+    return samples / elapsed if elapsed > 0 else 0.
+
+def bench_dataloader(args):
+    """
+    Time of each loading stage and samples/s of the DataLoader for each
+    number of workers, batch size and pin memory, the fastest setting is
+    saved as a loader config (see read_data.loader_kwargs).
+    """
+    dataset = create_dataset(args)
+    print(f"{len(dataset)} samples")
+
+    times = stage_times(dataset, args.stage_samples)
+    print("Main process, ms per sample: " + ", ".join(f"{stage} {t:.2f}" for stage, t in times.items()))
+
+    results = []
+    for num_workers, batch_size, pin_memory in itertools.product(args.workers, args.batch_sizes, args.pin_memory):
+        loader_config = {"num_workers": num_workers, "pin_memory": bool(pin_memory), "persistent_workers": num_workers > 0, "prefetch_factor": args.prefetch_factor}
+        # A new dataset for each setting, so no setting starts with the frame cache of the previous ones
+        dataset = create_dataset(args)
+        throughput = loader_throughput(dataset, batch_size, loader_config, args.batches)
+        results.append((throughput, batch_size, loader_config))
+        print(f"workers={num_workers} batch_size={batch_size} pin_memory={bool(pin_memory)}: {throughput:.1f} samples/s")
+        ## Hit rate of the frame cache of each worker, to size cache_size
+        if isinstance(dataset, ld.ColorizationDataset):
+            stats = dataset.cache_stats()
+            print(f"    frame cache (cache_size={args.cache_size}): hit rate {stats['hit_rate']:.2f}, by process {stats['hit_rate_by_process']}")
+
+    throughput, batch_size, loader_config = max(results, key=lambda result: result[0])
+    loader_config = dict(loader_config, batch_size=batch_size, samples_per_second=throughput)
+    print(f"Recommended: {loader_config}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(loader_config, f, indent=1)
+
+def bench_train_step(args):
+    """
+    Time per training step (forward, backward, optimizer and EMA) of
+    TrainDiffusion.train_epoch with each precision, on random latents.
+    """
+    from train_diffusion import TrainDiffusion
+
+    diffusion = Diffusion(img_size=args.image_size//8, device=args.device, noise_steps=args.noise_steps)
+    batches = [(torch.randn(args.batch_size, 4, args.image_size//8, args.image_size//8), torch.randn(args.batch_size, 50, 768), None) for _ in range(args.steps)]
+
+    for precision in args.precisions:
+        training = TrainDiffusion(None, None, args.image_size, args.time_dim, precision=precision)
+        model = create_model(args)
+        ema_model = copy.deepcopy(model).eval().requires_grad_(False)
+        optimizer = torch.optim.Adam(model.parameters(), lr=2e-5)
+        criterion = torch.nn.MSELoss()
+        scaler = training.create_scaler(args.device)
+        train = lambda data: training.train_epoch(diffusion, model, args.device, data, criterion, optimizer, EMA(0.995), ema_model, scaler)
+
+        # Warm up
+        train(batches[:1])
+        elapsed, memory = timeit(lambda: train(batches), args.device)
+        loss = train(batches[:1])[0].item()
+        print(f"{precision}: {1000 * elapsed / args.steps:.1f} ms/step, peak memory {memory:.1f} MiB, loss {loss:.4f}")
+
+## Blocks of UNet_conditional checkpointed by each setting
+CHECKPOINT_SETTINGS = {
+    "none": (),
+    "attention": ("sa1", "sa2", "sa5", "sa6"),
+    "full_resolution": ("inc", "sa1", "up3", "sa6"),
+    "all": ("inc", "down1", "sa1", "down2", "sa2", "bot1", "bot3", "up2", "sa5", "up3", "sa6"),
+}
+
+def bench_checkpointing(args):
+    """
+    Peak memory and time of a forward and backward of UNet_conditional with
+    the activation checkpointing of each setting, compared to no checkpointing.
+    """
+    diffusion = Diffusion(img_size=args.image_size//8, device=args.device, noise_steps=args.noise_steps)
+    x = torch.randn(args.batch_size, 4, args.image_size//8, args.image_size//8, device=args.device)
+    labels = torch.randn(args.batch_size, 50, 768, device=args.device)
+    t = diffusion.sample_timesteps(args.batch_size).to(args.device)
+
+    baseline = None
+    for setting in args.settings:
+        torch.manual_seed(2023)
+        model = create_model(args, checkpoint_blocks=CHECKPOINT_SETTINGS[setting]).train()
+
+        def step():
+            model.zero_grad(set_to_none=True)
+            model(x, t, labels).square().mean().backward()
+
+        # Warm up
+        step()
+        elapsed, memory = timeit(step, args.device, repeat=args.repeat)
+        if baseline is None:
+            baseline = (elapsed, memory)
+        print(f"{setting}: {1000 * elapsed:.1f} ms ({100 * (elapsed / baseline[0] - 1):+.1f}%), "
+              f"peak memory {memory:.1f} MiB ({memory - baseline[1]:+.1f} MiB)")
+        del model
+
+def bench_attention(args):
+    """
+    Latency and peak memory of SelfAttention with each backend, and the
+    difference of the outputs with the nn.MultiheadAttention one (same weights).
+    """
+    x = torch.randn(args.batch_size, args.channels, args.size, args.size, device=args.device)
+    reference = SelfAttention(args.channels, args.size).to(args.device).eval()
+
+    with torch.no_grad():
+        expected = reference(x)
+        for backend in args.backends:
+            attention = SelfAttention(args.channels, args.size, backend=backend, chunk_size=args.chunk_size, window=args.window).to(args.device).eval()
+            attention.load_state_dict(reference.state_dict())
+
+            # Warm up
+            out = attention(x)
+            elapsed, memory = timeit(lambda: attention(x), args.device, repeat=args.repeat)
+            error = (out - expected).abs().max().item()
+            print(f"{backend}: {1000 * elapsed:.2f} ms, peak memory {memory:.1f} MiB, max difference {error:.2e}")
+
+def str_list(value):
+    return value.split(",")
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+def add_model_args(parser):
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--image_size", type=int, default=224)
+    parser.add_argument("--time_dim", type=int, default=1000)
+    parser.add_argument("--net_dimension", type=int, default=100)
+    parser.add_argument("--noise_steps", type=int, default=200)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    sampling = subparsers.add_parser("sampling", help="latency and memory of Diffusion.sample")
+    add_model_args(sampling)
+    sampling.add_argument("--sampler", default="ddim")
+    sampling.add_argument("--steps", type=int, default=20)
+    sampling.add_argument("--cfg_scale", type=float, default=0)
+    sampling.set_defaults(run=bench_sampling)
+
+    dataloader = subparsers.add_parser("dataloader", help="throughput of ReadData / ReadLatent and loader config autotuning")
+    dataloader.add_argument("--dataroot", required=True)
+    dataloader.add_argument("--latents", action="store_true", help="dataroot is a latents folder (ReadLatent)")
+    dataloader.add_argument("--file_name", default="latents.npz")
+    dataloader.add_argument("--image_size", type=int, default=224)
+    dataloader.add_argument("--train", action="store_true", help="with the training augmentation")
+    dataloader.add_argument("--cache_size", type=int, default=512)
+    dataloader.add_argument("--workers", type=int_list, default=[0, 2, 4, 8])
+    dataloader.add_argument("--batch_sizes", type=int_list, default=[16, 32, 64])
+    dataloader.add_argument("--pin_memory", type=int_list, default=[0, 1])
+    dataloader.add_argument("--prefetch_factor", type=int, default=2)
+    dataloader.add_argument("--batches", type=int, default=20, help="batches measured by setting")
+    dataloader.add_argument("--stage_samples", type=int, default=64, help="samples of the per stage times")
+    dataloader.add_argument("--output", default="loader_config.json")
+    dataloader.set_defaults(run=bench_dataloader)
+
+    train_step = subparsers.add_parser("train_step", help="time per training step of each precision")
+    add_model_args(train_step)
+    train_step.add_argument("--precisions", type=str_list, default=["fp32", "bf16"])
+    train_step.add_argument("--steps", type=int, default=10)
+    train_step.set_defaults(run=bench_train_step)
+
+    checkpointing = subparsers.add_parser("checkpointing", help="memory saved and extra time of the activation checkpointing")
+    add_model_args(checkpointing)
+    checkpointing.add_argument("--settings", type=str_list, default=list(CHECKPOINT_SETTINGS), help=f"of {list(CHECKPOINT_SETTINGS)}, the first is the reference")
+    checkpointing.add_argument("--repeat", type=int, default=5)
+    checkpointing.set_defaults(run=bench_checkpointing)
+
+    attention = subparsers.add_parser("attention", help="latency and memory of the SelfAttention backends")
+    attention.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    attention.add_argument("--batch_size", type=int, default=8)
+    attention.add_argument("--channels", type=int, default=200)
+    attention.add_argument("--size", type=int, default=28, help="latent resolution (size x size tokens)")
+    attention.add_argument("--backends", type=str_list, default=["mha", "sdpa", "chunked", "window"])
+    attention.add_argument("--chunk_size", type=int, default=1024)
+    attention.add_argument("--window", type=int, default=7)
+    attention.add_argument("--repeat", type=int, default=10)
+    attention.set_defaults(run=bench_attention)
+
+    args = parser.parse_args()
+    torch.manual_seed(2023)
+    args.run(args)
@@ -43,6 +43,16 @@ class Diffusion:
         # self.img_size = 8
         self.device = device
 
+        ## Precompute the time embeddings and the conditioning of the model on sampling
+        self.cache_inference = True
+
+        ## Available reverse process steps
+        self.samplers = {
+            "ddpm": self.ddpm_step,
+            "ddim": self.ddim_step,
+            "dpmpp2m": self.dpmpp2m_step,
+        }
+
     def prepare_noise_schedule(self):
         return torch.linspace(self.beta_start, self.beta_end, self.noise_steps)
 
@@ -55,32 +65,288 @@ class Diffusion:
     def sample_timesteps(self, n):
         return torch.randint(low=1, high=self.noise_steps, size=(n,))
 
-    def sample(self, model, n, labels, gray_img=None, cfg_scale=0, in_ch=3, create_img=True):
+    def schedule(self, steps=None, t_start=None):
+        """
+        Return the decreasing list of timesteps visited by the reverse process,
+        from t_start (default the last trained step) down to 0 (the clean latent).
+        With steps=None every trained step is visited, otherwise the chain is
+        strided to `steps` model evaluations. Schedules are nested, the one with
+        `steps` is every second element of the one with `2*steps`.
+        """
+        if t_start is None:
+            t_start = self.noise_steps - 1
+        if steps is None or steps > t_start:
+            steps = t_start
+        return [(t_start * (steps - k)) // steps for k in range(steps + 1)]
+
+    def alpha_hat_at(self, t):
+        """
+        Cumulative alpha of the step t, where t = 0 stands for the clean latent.
+        """
+        if t == 0:
+            return torch.ones((), device=self.alpha_hat.device)
+        return self.alpha_hat[t]
+
+    def prepare_condition(self, model, labels, cfg_scale=0):
+        """
+        Condition of a sample call, with cfg_scale > 0 the null condition
+        (model.null_cond) is stacked after the labels. When cache_inference is
+        set the invariant conditioning of the model is computed only once.
+        """
+        if cfg_scale > 0:
+            labels = torch.cat([labels, model.null_cond.to(labels.dtype).expand_as(labels)])
+        if self.cache_inference:
+            return model.encode_condition(labels)
+        return labels
+
+    def predict_noise(self, model, x, t, cond, cfg_scale=0):
+        """
+        Predict the noise of x (cond from prepare_condition), with cfg_scale > 0
+        the conditioned and the null conditioned inputs run in a single forward.
+        """
+        if cfg_scale > 0:
+            predicted_noise, uncond_predicted_noise = model(torch.cat([x, x]), torch.cat([t, t]), cond).chunk(2)
+            return torch.lerp(uncond_predicted_noise, predicted_noise, cfg_scale)
+        return model(x, t, cond)
+
+    def ddpm_step(self, x, predicted_noise, t, t_next, state, eta=1.):
+        """
+        Ancestral step of the DDPM, when t_next is not t-1 the step is
+        taken with the equivalent alpha of the strided chain.
+        """
+        if t_next == t - 1:
+            alpha, beta = self.alpha[t], self.beta[t]
+        else:
+            alpha = self.alpha_hat[t] / self.alpha_hat_at(t_next)
+            beta = 1 - alpha
+        alpha_hat = self.alpha_hat[t]
+        if t_next > 0:
+            noise = torch.randn_like(x)
+        else:
+            noise = torch.zeros_like(x)
+        return 1 / torch.sqrt(alpha) * (x - ((1 - alpha) / (torch.sqrt(1 - alpha_hat))) * predicted_noise) + torch.sqrt(beta) * noise
+
+    def ddim_step(self, x, predicted_noise, t, t_next, state, eta=0.):
+        """
+        DDIM step from t to t_next, eta=0 is deterministic and eta=1
+        has the same noise level of the ancestral sampler.
+        """
+        alpha_hat = self.alpha_hat[t]
+        alpha_hat_next = self.alpha_hat_at(t_next)
+
+        x0 = (x - torch.sqrt(1 - alpha_hat) * predicted_noise) / torch.sqrt(alpha_hat)
+        sigma = eta * torch.sqrt((1 - alpha_hat_next) / (1 - alpha_hat) * (1 - alpha_hat / alpha_hat_next))
+
+        x = torch.sqrt(alpha_hat_next) * x0 + torch.sqrt((1 - alpha_hat_next - sigma ** 2).clamp(min=0)) * predicted_noise
+        if eta > 0 and t_next > 0:
+            x = x + sigma * torch.randn_like(x)
+        return x
+
+    def lambda_at(self, t):
+        """
+        Half log-SNR of the step t, log(alpha_t / sigma_t).
+        """
+        alpha_hat = self.alpha_hat_at(t)
+        return 0.5 * (torch.log(alpha_hat) - torch.log(1 - alpha_hat))
+
+    def dpmpp2m_step(self, x, predicted_noise, t, t_next, state, eta=0.):
+        """
+        Second order multistep DPM-Solver++ (2M) step from t to t_next.
+        The solver keeps in state the clean latent predicted on the previous
+        step to extrapolate the current one, the first and last steps are first
+        order. eta is ignored (the solver is deterministic).
+        """
+        alpha_hat = self.alpha_hat[t]
+        alpha_hat_next = self.alpha_hat_at(t_next)
+        x0 = (x - torch.sqrt(1 - alpha_hat) * predicted_noise) / torch.sqrt(alpha_hat)
+
+        history = state.setdefault("history", [])
+        lambda_t = self.lambda_at(t)
+
+        if t_next == 0:
+            # Last step lands directly on the clean latent
+            x = x0
+        else:
+            h = self.lambda_at(t_next) - lambda_t
+            if history:
+                lambda_prev, x0_prev = history[-1]
+                r = (lambda_t - lambda_prev) / h
+                d = (1 + 1 / (2 * r)) * x0 - (1 / (2 * r)) * x0_prev
+            else:
+                d = x0
+            x = torch.sqrt((1 - alpha_hat_next) / (1 - alpha_hat)) * x - torch.sqrt(alpha_hat_next) * torch.expm1(-h) * d
+
+        history.append((lambda_t, x0))
+        del history[:-1]
+        return x
+
+    def select_state(self, state, keep):
+        """
+        Keep in the sampler state only the samples selected by the mask keep.
+        """
+        def select(value):
+            if torch.is_tensor(value) and value.dim() > 0:
+                return value[keep]
+            if isinstance(value, (list, tuple)):
+                return type(value)(select(v) for v in value)
+            return value
+
+        for key in state:
+            state[key] = select(state[key])
+
+    def denoise(self, model, x, labels, timesteps, sampler="ddpm", cfg_scale=0, eta=0., tol=None):
+        """
+        Run the reverse process over x following the timesteps (see schedule).
+        tol: early exit, a sample stops when the mean absolute change of its
+        predicted clean latent between two steps is below tol. Its result is the
+        predicted clean latent and it leaves the batch of the next forwards.
+        Return the denoised x and the number of model evaluations of each sample.
+        """
+        if sampler not in self.samplers:
+            raise ValueError(f"Unknown sampler {sampler}, use one of {list(self.samplers)}")
+        step = self.samplers[sampler]
+
+        out = torch.empty_like(x)
+        n_steps = torch.zeros(x.shape[0], dtype=torch.long, device=x.device)
+        # Index (in out) of the samples still denoising
+        active = torch.arange(x.shape[0], device=x.device)
+        x0_prev = None
+
+        if self.cache_inference:
+            model.prepare_inference(self.noise_steps)
+        else:
+            model.time_table = None
+
+        ## The time table is only used while sampling, the training forwards compute the encodings
+        try:
+            cond = self.prepare_condition(model, labels, cfg_scale)
+
+            # Sampler state (e.g. history of the multistep solvers)
+            state = {}
+            for t, t_next in zip(timesteps[:-1], timesteps[1:]):
+                t_batch = torch.full((x.shape[0],), t, dtype=torch.long, device=self.device)
+                predicted_noise = self.predict_noise(model, x, t_batch, cond, cfg_scale)
+                n_steps[active] += 1
+
+                if tol is not None and t_next > 0:
+                    alpha_hat = self.alpha_hat[t]
+                    x0 = (x - torch.sqrt(1 - alpha_hat) * predicted_noise) / torch.sqrt(alpha_hat)
+                    if x0_prev is not None:
+                        done = (x0 - x0_prev).abs().flatten(1).mean(1) < tol
+                        if done.any():
+                            out[active[done]] = x0[done]
+                            keep = ~done
+                            active, x, predicted_noise, x0 = active[keep], x[keep], predicted_noise[keep], x0[keep]
+                            cond_keep = torch.cat([keep, keep]) if cfg_scale > 0 else keep
+                            cond = cond[cond_keep] if torch.is_tensor(cond) else tuple(c[cond_keep] for c in cond)
+                            self.select_state(state, keep)
+                            if active.numel() == 0:
+                                break
+                    x0_prev = x0
+
+                x = step(x, predicted_noise, t, t_next, state, eta)
+
+            out[active] = x
+            return out, n_steps
+        finally:
+            model.time_table = None
+
+    def sample(self, model, n=None, labels=None, gray_img=None, cfg_scale=0, in_ch=3, create_img=True, sampler="ddpm", steps=None, eta=0., tol=None, return_steps=False):
+        """
+        Generate n samples conditioned on the labels.
+        sampler: "ddpm" (ancestral), "ddim" or "dpmpp2m" (multistep solver,
+        good quality with 10-20 steps), see self.samplers.
+        steps: number of model evaluations, None walks every trained step.
+        eta: stochasticity of the ddim sampler (0 is deterministic).
+        tol: early exit tolerance of each sample (see denoise), None runs every step.
+        return_steps: also return the number of model evaluations of each sample.
+        """
         # logging.info(f"Sampling {n} new images....")
+        if n is None:
+            n = labels.shape[0]
         model.eval()
         with torch.no_grad():
             x = torch.randn((n, in_ch, int(self.img_size), int(self.img_size))).to(self.device)
-            for i in reversed(range(1, self.noise_steps)):
-                t = (torch.ones(n) * i).long().to(self.device)
-                predicted_noise = model(x, t, labels)
-                if cfg_scale > 0:
-                    uncond_predicted_noise = model(x, t, None)
-                    predicted_noise = torch.lerp(uncond_predicted_noise, predicted_noise, cfg_scale)
-                alpha = self.alpha[t][:, None, None, None]
-                alpha_hat = self.alpha_hat[t][:, None, None, None]
-                beta = self.beta[t][:, None, None, None]
-                if i > 1:
-                    noise = torch.randn_like(x)
-                else:
-                    noise = torch.zeros_like(x)
-                x = 1 / torch.sqrt(alpha) * (x - ((1 - alpha) / (torch.sqrt(1 - alpha_hat))) * predicted_noise) + torch.sqrt(beta) * noise
+            x, n_steps = self.denoise(model, x, labels, self.schedule(steps), sampler=sampler, cfg_scale=cfg_scale, eta=eta, tol=tol)
         model.train()
 
         if create_img:
             x = tensor_lab_2_rgb(x)
 
+        if return_steps:
+            return x, n_steps
         return x
 
+    def is_scene_cut(self, prev_labels, labels, cut_threshold=0.9):
+        """
+        Detect a scene cut between each pair of frames comparing the class
+        token of their ViT labels with the cosine similarity.
+        """
+        similarity = torch.cosine_similarity(prev_labels[:, 0].float(), labels[:, 0].float(), dim=-1)
+        return similarity < cut_threshold
+
+    def sample_video(self, model, labels, video_idx=None, prev_frames=None, strength=0.5, cut_threshold=0.9, in_ch=4, sampler="ddpm", steps=None, eta=0., cfg_scale=0):
+        """
+        Sample the latents of a batch of frames pooled from videos (the frames
+        of each video in order). Each frame starts from the latent of the
+        previous frame of its video re-noised with noise_images to the step
+        strength*noise_steps (SDEdit) and is only denoised from there. The first
+        frame of a video and the frames after a scene cut (see is_scene_cut)
+        run the full chain.
+        The n-th frames of the videos are denoised together, the warm started
+        ones in a batch and the full chain ones in another.
+        video_idx: video of each frame (None is a single video).
+        prev_frames: dict video -> (latent, labels) of its last frame, updated
+        to chain the batches of the same video.
+        steps: model evaluations of the full chain, the warm started frames use
+        the same stride (about strength*steps evaluations).
+        """
+        t_start = int(strength * (self.noise_steps - 1))
+        warm_steps = None if steps is None else max(1, round(steps * strength))
+        if video_idx is None:
+            video_idx = [0] * labels.shape[0]
+        elif torch.is_tensor(video_idx):
+            video_idx = video_idx.tolist()
+        if prev_frames is None:
+            prev_frames = {}
+
+        ## Frames of each round (the n-th frame of each video in the batch)
+        rounds = []
+        position = {}
+        for i, video in enumerate(video_idx):
+            n = position.get(video, 0)
+            position[video] = n + 1
+            if n == len(rounds):
+                rounds.append([])
+            rounds[n].append(i)
+
+        model.eval()
+        out = torch.empty((labels.shape[0], in_ch, int(self.img_size), int(self.img_size)), device=self.device)
+        with torch.no_grad():
+            for frames in rounds:
+                ## Warm start the frames with a previous frame of the same scene
+                warm = [i for i in frames if video_idx[i] in prev_frames and t_start > 0]
+                if warm:
+                    prev_labels = torch.cat([prev_frames[video_idx[i]][1] for i in warm])
+                    cut = self.is_scene_cut(prev_labels, labels[warm], cut_threshold).tolist()
+                    warm = [i for i, is_cut in zip(warm, cut) if not is_cut]
+                cold = [i for i in frames if i not in warm]
+
+                if warm:
+                    prev = torch.cat([prev_frames[video_idx[i]][0] for i in warm])
+                    t = torch.full((len(warm),), t_start, dtype=torch.long, device=self.device)
+                    x, _ = self.noise_images(prev, t)
+                    out[warm], _ = self.denoise(model, x, labels[warm], self.schedule(warm_steps, t_start), sampler=sampler, cfg_scale=cfg_scale, eta=eta)
+                if cold:
+                    x = torch.randn((len(cold), in_ch, int(self.img_size), int(self.img_size))).to(self.device)
+                    out[cold], _ = self.denoise(model, x, labels[cold], self.schedule(steps), sampler=sampler, cfg_scale=cfg_scale, eta=eta)
+
+                for i in frames:
+                    prev_frames[video_idx[i]] = (out[i:i+1], labels[i:i+1])
+        model.train()
+
+        return out
+
 def train(args):
     setup_logging(args.run_name)
     logger = SummaryWriter(os.path.join("runs", args.run_name))
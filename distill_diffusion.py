@@ -0,0 +1,195 @@
+"""
+Progressive distillation of a trained diffusion model (Salimans and Ho, 2022).
+Each round trains a student to reproduce two deterministic (ddim) steps of the
+teacher with a single step, so the student needs half of the teacher steps.
+The student of one round is the teacher of the next one and the students are
+sampled with Diffusion.sample(..., sampler="ddim", steps=student_steps).
+"""
+import os
+import copy
+import itertools
+import tempfile
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch import optim
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+import read_data as ld
+from ddpm import Diffusion
+from modules import UNet_conditional
+from utils import *
+
+class DistillDiffusion():
+    def __init__(self, dataroot, image_size, time_dim, net_dimension, noise_steps, latent_file_name="latents.npz", device="cuda", learned_null=False) -> None:
+
+        self.dataroot = dataroot
+        self.image_size = image_size
+        self.time_dim = time_dim
+        self.net_dimension = net_dimension
+        self.noise_steps = noise_steps
+        self.latent_file_name = latent_file_name
+        self.device = device
+        self.learned_null = learned_null
+        self.run_name = get_model_time()
+
+    def create_model(self):
+        return UNet_conditional(c_in=4, c_out=4, time_dim=self.time_dim, img_size=self.image_size//8, net_dimension=self.net_dimension,
+                                device=self.device, learned_null=self.learned_null).to(self.device)
+
+    def read_dataloader(self, batch_size):
+        """
+        Get the latents and the ViT labels and return the dataloader
+        """
+        dataset = ld.latents_dataset(self.dataroot, self.latent_file_name)
+        return DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=len(dataset) > batch_size)
+
+    def alpha_hat(self, diffusion, t):
+        """
+        alpha_hat for a batch of timesteps, t = 0 is the clean latent.
+        """
+        alpha_hat = torch.where(t > 0, diffusion.alpha_hat[t], torch.ones_like(diffusion.alpha_hat[t]))
+        return alpha_hat[:, None, None, None]
+
+    def ddim(self, x, predicted_noise, alpha_hat, alpha_hat_next):
+        x0 = (x - torch.sqrt(1 - alpha_hat) * predicted_noise) / torch.sqrt(alpha_hat)
+        return torch.sqrt(alpha_hat_next) * x0 + torch.sqrt(1 - alpha_hat_next) * predicted_noise
+
+    def distill_loss(self, diffusion, teacher, student, latents, labels, timesteps, criterion):
+        """
+        Loss of the student doing in one step the two teacher steps
+        timesteps[2k] -> timesteps[2k+1] -> timesteps[2k+2].
+        """
+        n = latents.shape[0]
+        timesteps = torch.tensor(timesteps, device=self.device)
+
+        k = torch.randint(0, (len(timesteps) - 1) // 2, (n,), device=self.device)
+        t, t_mid, t_next = timesteps[2*k], timesteps[2*k+1], timesteps[2*k+2]
+        alpha_hat, alpha_hat_mid, alpha_hat_next = self.alpha_hat(diffusion, t), self.alpha_hat(diffusion, t_mid), self.alpha_hat(diffusion, t_next)
+
+        x_t, _ = diffusion.noise_images(latents, t)
+
+        with torch.no_grad():
+            ### Two deterministic steps of the teacher
+            x_mid = self.ddim(x_t, teacher(x_t, t, labels), alpha_hat, alpha_hat_mid)
+            x_target = self.ddim(x_mid, teacher(x_mid, t_mid, labels), alpha_hat_mid, alpha_hat_next)
+
+            ### Clean latent (and noise) that takes x_t to x_target in a single step
+            ratio = torch.sqrt(1 - alpha_hat_next) / torch.sqrt(1 - alpha_hat)
+            x0 = (x_target - ratio * x_t) / (torch.sqrt(alpha_hat_next) - ratio * torch.sqrt(alpha_hat))
+            noise_target = (x_t - torch.sqrt(alpha_hat) * x0) / torch.sqrt(1 - alpha_hat)
+
+        predicted_noise = student(x_t, t, labels)
+        return criterion(predicted_noise, noise_target)
+
+    def train_round(self, diffusion, teacher, dataloader, teacher_steps, iterations, lr):
+        """
+        Distill the teacher sampled with teacher_steps into a student
+        sampled with teacher_steps // 2.
+        """
+        teacher.eval().requires_grad_(False)
+        student = copy.deepcopy(teacher).train().requires_grad_(True)
+
+        optimizer = optim.Adam(student.parameters(), lr=lr)
+        criterion = nn.MSELoss()
+        timesteps = diffusion.schedule(teacher_steps)
+
+        data_iter = itertools.cycle(dataloader)
+        pbar = tqdm(range(iterations), desc=f"Distill {teacher_steps} -> {teacher_steps // 2} steps")
+        for _ in pbar:
+            latents, labels, _ = next(data_iter)
+            latents = latents.to(self.device).float()
+            labels = labels.to(self.device).float()
+
+            loss = self.distill_loss(diffusion, teacher, student, latents, labels, timesteps, criterion)
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            pbar.set_postfix(MSE=loss.item())
+
+        return student
+
+    def train(self, teacher_name, teacher_file="ema_ckpt", teacher_steps=64, rounds=4, iterations=5000, lr=1e-5, batch_size=32, model_path="unet_model"):
+        """
+        Run the distillation rounds, the student of each round is saved as
+        student_{steps}.pt in model_path/run_name.
+        """
+        if teacher_steps % (2 ** rounds) or teacher_steps > self.noise_steps - 1:
+            raise ValueError(f"teacher_steps must be <= {self.noise_steps - 1} and divisible by 2**rounds ({2 ** rounds})")
+
+        diffusion = Diffusion(img_size=self.image_size//8, device=self.device, noise_steps=self.noise_steps)
+        dataloader = self.read_dataloader(batch_size)
+
+        ## Read the teacher weights
+        teacher = load_trained_weights(self.create_model(), teacher_name, teacher_file, model_path=model_path)
+
+        pos_path_save_models = os.path.join(model_path, self.run_name)
+        os.makedirs(pos_path_save_models, exist_ok=True)
+
+        for _ in range(rounds):
+            student = self.train_round(diffusion, teacher, dataloader, teacher_steps, iterations, lr)
+            teacher_steps //= 2
+            checkpoint(student, os.path.join(pos_path_save_models, f"student_{teacher_steps}.pt"))
+            teacher = student
+
+        return teacher, diffusion, teacher_steps
+
+def cpu_test():
+    """
+    End to end distillation on CPU with a tiny model and random latents.
+    """
+    root = tempfile.mkdtemp()
+    dataroot = os.path.join(root, "latens") + os.sep
+    model_path = os.path.join(root, "unet_model")
+    os.makedirs(dataroot)
+    os.makedirs(os.path.join(model_path, "teacher"))
+
+    n = 8
+    np.savez(dataroot + "latents", latents=np.random.randn(n, 1, 4, 28, 28).astype(np.float32), labels=np.random.randn(n, 1, 50, 768).astype(np.float32))
+
+    distill = DistillDiffusion(dataroot, image_size=224, time_dim=32, net_dimension=4, noise_steps=20, device="cpu")
+    checkpoint(distill.create_model(), os.path.join(model_path, "teacher", "ckpt.pt"))
+
+    student, diffusion, steps = distill.train("teacher", "ckpt", teacher_steps=8, rounds=2, iterations=2, batch_size=4, model_path=model_path)
+
+    labels = torch.randn(2, 50, 768)
+    x = diffusion.sample(student, labels=labels, in_ch=4, create_img=False, sampler="ddim", steps=steps)
+    print(f"Student with {steps} steps: {x.shape}")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cpu_test", action="store_true", help="tiny end to end run on CPU")
+    args, unknown = parser.parse_known_args()
+
+    if args.cpu_test:
+        cpu_test()
+    else:
+        ### Hyperparameters
+        seed = 42
+        torch.manual_seed(seed)
+        noise_steps = 200
+        time_dim = 1000
+        device = "cuda"
+        image_size = 224
+        net_dimension = 100
+        batch_size = 32
+
+        used_dataset = "LDV"
+        dataroot = f"./diffusion/data/latens/{used_dataset}/"
+        latent_file_name = "latents.npz"
+        teacher_name = "Diffusion_20231024_153532"
+
+        ## 64 -> 32 -> 16 -> 8 -> 4 steps
+        teacher_steps = 64
+        rounds = 4
+        iterations = 5000
+        lr = 1e-5
+
+        distill = DistillDiffusion(dataroot, image_size, time_dim, net_dimension, noise_steps, latent_file_name=latent_file_name, device=device)
+        distill.train(teacher_name, "ema_ckpt", teacher_steps=teacher_steps, rounds=rounds, iterations=iterations, lr=lr, batch_size=batch_size)
+
+    print("Done")
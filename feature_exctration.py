@@ -1,16 +1,25 @@
+import os
+import json
+import hashlib
 import torch
-import pickle
 import VAE as vae
 import read_data as ld
 import ViT as vit
 from utils import *
-import os
 from tqdm import tqdm
 import numpy as np
+from torch.utils.data import DataLoader, Subset
+from latent_store import LatentStore, LatentStoreWriter, write_json
 
 """
 This script is for extract the features from the images and save it in a file,
 this process was realized to save time during the diffusion training.
+The latents and labels are streamed in chunks to a sharded latent store
+(see latent_store.py). The extraction is incremental: a manifest keeps a
+signature of the files of each scene and the version of the encoders, and
+only the new or changed scenes are encoded and appended to the store, the
+deleted ones are removed. An interrupted extraction resumes from the last
+scene completed.
 """
 
 ### Parameters
@@ -20,47 +29,121 @@ dataype = "train"
 dataroot = f"./data/{dataype}/{dataset}"
 latensroot = f"data/latens/{dataset}/"
 image_size = 224
-batch_size = 1
+batch_size = 32
 device = "cuda"
 size_data = 1
-# latent_filename = "latents_transf"
-latent_filename = "latents"
+# Samples of each shard of the store
+chunk_size = 1024
+# Store the labels in float16 (None keeps float32)
+label_dtype = None
+# Disk cache of the ViT features of the frames without augmentation (None disables it),
+# the cache stores float16 features, so the labels are float16 values even with label_dtype None
+vit_cache_dir = None
+
+# Version of the encoders and of the extraction, when it changes every scene is extracted again
+encoder_version = hashlib.sha1(str(("CompVis/stable-diffusion-v1-4/vae", "ViT_B_32_Weights.IMAGENET1K_V1", image_size, size_data, label_dtype, vit_cache_dir is not None)).encode()).hexdigest()
+
+def scene_signature(path):
+    """
+    Hash of the names, sizes and modification times of the files of a scene.
+    """
+    files = []
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            stat = os.stat(os.path.join(dirpath, filename))
+            files.append((os.path.relpath(os.path.join(dirpath, filename), path), stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha1(str(sorted(files)).encode()).hexdigest()
+
+### Manifest with the extracted scenes
+manifest_path = os.path.join(latensroot, "extraction.json")
+
+os.makedirs(latensroot, exist_ok=True)
+if os.path.exists(manifest_path):
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+elif [name for name in os.listdir(latensroot) if not name.endswith(".npz")]:
+    # The latents.npz of the old extraction can stay in the folder (the store is read before
+    # it, see read_data.latents_dataset). Other files are e.g. a store converted from a
+    # latents.npz (latent_store.py), it has no scenes to update
+    raise ValueError(f"{latensroot} is not empty and has no extraction manifest, extract in an empty folder "
+                     "(a store converted with latent_store.py can't be updated incrementally)")
+else:
+    manifest = {"encoder": encoder_version, "scenes": {}}
+
+writer = LatentStoreWriter(latensroot, chunk_size=chunk_size, label_dtype=label_dtype)
 
-list_latens = []
-list_labels = []
+def save_progress():
+    write_json(manifest_path, manifest)
 
-for i in range(size_data):
-    ### Create the dataset
-    dataLoader = ld.ReadData()
-    dataloader = dataLoader.create_dataLoader(dataroot, image_size, batch_size, shuffle=False, train=True)
-    if i == size_data -1:
-        dataloader = dataLoader.create_dataLoader(dataroot, image_size, batch_size, shuffle=False, train=None)
+if manifest.get("encoder") != encoder_version:
+    print("Encoder changed, extracting all the scenes")
+    # The new samples also take the new dtypes
+    writer.clear(label_dtype=label_dtype)
+    manifest = {"encoder": encoder_version, "scenes": {}}
+    save_progress()
 
+### Compare the scenes on disk with the manifest
+scenes = sorted(entry.name for entry in os.scandir(dataroot) if entry.is_dir())
+signatures = {scene: scene_signature(os.path.join(dataroot, scene)) for scene in scenes}
+
+## Scenes deleted from disk (or partially extracted and deleted)
+for scene in (writer.scenes() | set(manifest["scenes"])) - set(scenes):
+    writer.remove_scene(scene)
+    manifest["scenes"].pop(scene, None)
+    save_progress()
+
+new_scenes = [scene for scene in scenes if manifest["scenes"].get(scene, {}).get("signature") != signatures[scene]]
+print(f"{len(scenes)} scenes, {len(new_scenes)} new or changed")
+
+if new_scenes:
     ### Load models
     prompt = vit.Vit_neck().to(device)
+    prompt.eval()
+    cached_prompt = vit.VitCache(prompt, vit_cache_dir) if vit_cache_dir else prompt
 
-    ### Create the folder to save the latens
-    os.makedirs(latensroot, exist_ok=True)
+    ### Create the datasets (with augmentation except in the last pass)
+    passes = [ld.ColorizationDataset(dataroot, image_size, train=True if i < size_data - 1 else None, cache_size=0).dataset for i in range(size_data)]
+    frames = passes[-1]
+
+    ## Frames of each scene
+    scene_frames = {scene: [] for scene in frames.classes}
+    for index, target in enumerate(frames.targets):
+        scene_frames[frames.classes[target]].append(index)
 
     ## Loop for get the latents
+    pbar = tqdm(new_scenes)
+    for scene in pbar:
+        # Drop the old (or partial) samples of the scene
+        writer.remove_scene(scene)
+
+        for i, pass_frames in enumerate(passes):
+            pbar.set_description(f" Epoc: {i}, Extracting features of {scene}")
+            dataloader = DataLoader(Subset(pass_frames, scene_frames[scene]), batch_size=batch_size, shuffle=False)
+
+            ## Cache only the frames without augmentation
+            labels_model = cached_prompt if i == size_data - 1 else prompt
 
-    pbar = tqdm(dataloader)
-    for data in pbar:
-        pbar.set_description(f" Epoc: {i}, Extracting features")
-        img, img_gray, _, _ = create_samples(data)
+            for img, _ in dataloader:
+                img_gray = transforms.Grayscale(num_output_channels=3)(img)
+                img, img_gray = img.to(device), img_gray.to(device)
 
-        latens = vae.pil_to_latents(img)
-        list_latens.append(latens.to("cpu").detach().numpy())
+                with torch.no_grad():
+                    latens = vae.pil_to_latents(img).to("cpu").numpy()
+                    labels = labels_model(img_gray).to("cpu").numpy()
 
-        labels = prompt(img_gray)
-        list_labels.append(labels.to("cpu").detach().numpy())
+                writer.append(latens, labels, scene=scene)
 
-np.savez(latensroot+latent_filename, labels=list_labels, latents=list_latens)
+        ## The scene is complete
+        writer.flush()
+        manifest["scenes"][scene] = {"signature": signatures[scene], "frames": len(scene_frames[scene])}
+        save_progress()
 
-del list_labels, list_latens
+    writer.close()
 
 print("Done!")
-data = np.load(latensroot+latent_filename+".npz", 'r')
+data = LatentStore(latensroot)
+latents, labels = data[0]
 
-print("Labels Shape: ", data["labels"].shape)
-print("Latents Shape: ", data["latents"].shape)
\ No newline at end of file
+print("Samples: ", len(data))
+print("Labels Shape: ", labels.shape)
+print("Latents Shape: ", latents.shape)
@@ -0,0 +1,99 @@
+"""
+Pre-decoded "frame pack" of a dataset of JPEG folders (one folder per scene).
+The frames of all the scenes are decoded once, resized to a square resolution
+and saved as a single uint8 array (frames.npy, N x H x W x 3) that is read with
+memory mapping. frame_pack.json has the offset and the length of each scene.
+
+Pack a dataset with:
+python frame_pack.py data/train/DAVIS data/packs/DAVIS --image_size 280
+"""
+import os
+import json
+
+import numpy as np
+import torchvision
+from PIL import Image
+from tqdm import tqdm
+
+from latent_store import write_json
+
+PACK_INDEX = "frame_pack.json"
+FRAMES_FILE = "frames.npy"
+
+def is_frame_pack(root):
+    return os.path.exists(os.path.join(root, PACK_INDEX))
+
+def pack_frames(src_root, out_root, image_size=280):
+    """
+    Decode the frames of src_root (ordered as ImageFolder) and save them resized
+    to image_size x image_size in a frame pack in out_root.
+    """
+    folder = torchvision.datasets.ImageFolder(src_root)
+    os.makedirs(out_root, exist_ok=True)
+
+    frames = np.lib.format.open_memmap(os.path.join(out_root, FRAMES_FILE), mode="w+", dtype=np.uint8, shape=(len(folder.samples), image_size, image_size, 3))
+
+    scenes = [{"name": name, "start": 0, "length": 0} for name in folder.classes]
+    for index, (path, target) in enumerate(tqdm(folder.samples, desc="Packing frames")):
+        with Image.open(path) as img:
+            frames[index] = np.asarray(img.convert("RGB").resize((image_size, image_size), Image.BILINEAR))
+        if scenes[target]["length"] == 0:
+            scenes[target]["start"] = index
+        scenes[target]["length"] += 1
+    frames.flush()
+    del frames
+
+    # The index is written last, a pack without index is not complete
+    write_json(os.path.join(out_root, PACK_INDEX), {"image_size": image_size, "scenes": [scene for scene in scenes if scene["length"]]})
+
+class FramePack():
+    """
+    Read a frame pack, pack[i] return the uint8 frame i (H x W x 3) from the
+    memory mapped array. The array is opened on the first access, so each
+    DataLoader worker maps it by itself.
+    """
+
+    def __init__(self, root) -> None:
+        self.root = root
+        with open(os.path.join(root, PACK_INDEX)) as f:
+            self.index = json.load(f)
+
+        self.image_size = self.index["image_size"]
+        self.classes = [scene["name"] for scene in self.index["scenes"]]
+        self.starts = np.array([scene["start"] for scene in self.index["scenes"]])
+        self.lengths = np.array([scene["length"] for scene in self.index["scenes"]])
+        # Scene of each frame
+        self.targets = np.repeat(np.arange(len(self.classes)), self.lengths)
+        self.frames = None
+
+    def __getstate__(self):
+        # The memory map is not sent to other processes
+        state = self.__dict__.copy()
+        state["frames"] = None
+        return state
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        if self.frames is None:
+            self.frames = np.load(os.path.join(self.root, FRAMES_FILE), mmap_mode="r")
+        return self.frames[index]
+
+    def scene_range(self, index):
+        """
+        Return the scene of the frame index and its first and last (excluded) frames.
+        """
+        scene = self.targets[index]
+        return scene, self.starts[scene], self.starts[scene] + self.lengths[scene]
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("src_root")
+    parser.add_argument("out_root")
+    parser.add_argument("--image_size", type=int, default=280, help="resolution of the packed frames")
+    args = parser.parse_args()
+
+    pack_frames(args.src_root, args.out_root, args.image_size)
+    print(f"{len(FramePack(args.out_root))} frames packed")
@@ -0,0 +1,237 @@
+"""
+Sharded on disk store of the latents and the ViT labels extracted by
+feature_exctration.py. Each shard is a pair of raw .npy files opened with
+memory mapping (so the data is never decompressed or copied to RAM), and
+index.json lists the shards in order with the scene of each one.
+
+root/
+    index.json
+    shard_00000_latents.npy
+    shard_00000_labels.npy
+    ...
+
+Convert a latents.npz with:
+python latent_store.py data/latens/LDV/latents.npz data/latens/LDV/ --label_dtype float16
+"""
+import os
+import json
+import bisect
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+
+def write_json(path, data):
+    """
+    Write a json file atomically (temporary file and rename).
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f, indent=1)
+    os.replace(temp_path, path)
+
+def write_npy(path, array):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(temp_path, path)
+
+def is_latent_store(root):
+    return os.path.exists(os.path.join(root, INDEX_FILE))
+
+class LatentStoreWriter():
+    """
+    Append latents and labels to a store (created if root has no index).
+    The samples are buffered and written in shards of chunk_size samples,
+    a shard only has samples of one scene. The index is updated after each
+    shard, so an interrupted writer keeps all the flushed shards.
+    """
+
+    def __init__(self, root, chunk_size=1024, label_dtype=None, latent_dtype=None) -> None:
+        self.root = root
+        self.chunk_size = chunk_size
+        os.makedirs(root, exist_ok=True)
+
+        if is_latent_store(root):
+            with open(os.path.join(root, INDEX_FILE)) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {"label_dtype": label_dtype, "latent_dtype": latent_dtype, "next_shard": 0, "shards": []}
+
+        self.latents = []
+        self.labels = []
+        self.buffered = 0
+        self.scene = None
+
+    def __len__(self):
+        """
+        Number of samples already flushed to the store.
+        """
+        return sum(shard["length"] for shard in self.index["shards"])
+
+    def append(self, latents, labels, scene=None):
+        """
+        Add a batch of latents and labels (numpy arrays or tensors) of a scene.
+        """
+        if scene != self.scene:
+            self.flush()
+            self.scene = scene
+
+        latents, labels = np.asarray(latents), np.asarray(labels)
+        if self.index["latent_dtype"]:
+            latents = latents.astype(self.index["latent_dtype"])
+        if self.index["label_dtype"]:
+            labels = labels.astype(self.index["label_dtype"])
+
+        self.latents.append(latents)
+        self.labels.append(labels)
+        self.buffered += len(latents)
+
+        while self.buffered >= self.chunk_size:
+            self.flush(self.chunk_size)
+
+    def flush(self, length=None):
+        """
+        Write length (default all) buffered samples in a new shard.
+        """
+        if self.buffered == 0:
+            return
+        latents, labels = np.concatenate(self.latents), np.concatenate(self.labels)
+        if length is None:
+            length = len(latents)
+
+        name = f"shard_{self.index['next_shard']:05d}"
+        write_npy(os.path.join(self.root, f"{name}_latents.npy"), latents[:length])
+        write_npy(os.path.join(self.root, f"{name}_labels.npy"), labels[:length])
+
+        self.index["next_shard"] += 1
+        self.index["shards"].append({"name": name, "scene": self.scene, "length": int(length)})
+        self.index.setdefault("latent_shape", list(latents.shape[1:]))
+        self.index.setdefault("label_shape", list(labels.shape[1:]))
+        write_json(os.path.join(self.root, INDEX_FILE), self.index)
+
+        self.latents, self.labels = [latents[length:]], [labels[length:]]
+        self.buffered = len(latents) - length
+
+    def scenes(self):
+        """
+        Return the scenes with samples in the store.
+        """
+        return {shard["scene"] for shard in self.index["shards"]}
+
+    def remove_scene(self, scene):
+        """
+        Delete the shards of a scene (the buffered samples are flushed before).
+        """
+        self.flush()
+        removed = [shard for shard in self.index["shards"] if shard["scene"] == scene]
+        if not removed:
+            return
+
+        # The index is updated first, so it never lists a deleted file
+        self.index["shards"] = [shard for shard in self.index["shards"] if shard["scene"] != scene]
+        write_json(os.path.join(self.root, INDEX_FILE), self.index)
+        for shard in removed:
+            for kind in ("latents", "labels"):
+                try:
+                    os.remove(os.path.join(self.root, f"{shard['name']}_{kind}.npy"))
+                except FileNotFoundError:
+                    pass
+
+    def clear(self, label_dtype=None, latent_dtype=None):
+        """
+        Delete every sample of the store and set the dtypes of the new ones.
+        """
+        for scene in self.scenes():
+            self.remove_scene(scene)
+        self.latents, self.labels, self.buffered = [], [], 0
+        self.index.update(label_dtype=label_dtype, latent_dtype=latent_dtype)
+        self.index.pop("latent_shape", None)
+        self.index.pop("label_shape", None)
+        write_json(os.path.join(self.root, INDEX_FILE), self.index)
+
+    def close(self):
+        self.flush()
+
+class LatentStore():
+    """
+    Read a store with memory mapping, store[i] return (latent, label) of the
+    sample i without copying it. The shards are opened on the first access,
+    so each DataLoader worker maps them by itself.
+    """
+
+    def __init__(self, root) -> None:
+        self.root = root
+        with open(os.path.join(root, INDEX_FILE)) as f:
+            self.index = json.load(f)
+
+        self.shards = self.index["shards"]
+        # First sample of each shard
+        self.offsets = np.cumsum([0] + [shard["length"] for shard in self.shards]).tolist()
+        self.arrays = None
+
+    def open(self):
+        self.arrays = [(np.load(os.path.join(self.root, f"{shard['name']}_latents.npy"), mmap_mode="r"),
+                        np.load(os.path.join(self.root, f"{shard['name']}_labels.npy"), mmap_mode="r")) for shard in self.shards]
+
+    def __getstate__(self):
+        # The memory maps are not sent to other processes
+        state = self.__dict__.copy()
+        state["arrays"] = None
+        return state
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def locate(self, index):
+        """
+        Return the shard and the position in the shard of a sample.
+        """
+        if index < 0:
+            index += len(self)
+        shard = bisect.bisect_right(self.offsets, index) - 1
+        return shard, index - self.offsets[shard]
+
+    def __getitem__(self, index):
+        if self.arrays is None:
+            self.open()
+        shard, position = self.locate(index)
+        latents, labels = self.arrays[shard]
+        return latents[position], labels[position]
+
+    def scene_ranges(self):
+        """
+        Return {scene: [(start, end), ...]} with the samples of each scene.
+        """
+        ranges = {}
+        for shard, start, end in zip(self.shards, self.offsets[:-1], self.offsets[1:]):
+            ranges.setdefault(shard["scene"], []).append((start, end))
+        return ranges
+
+def convert_npz(npz_path, root, chunk_size=1024, label_dtype=None):
+    """
+    Convert a latents.npz (from feature_exctration.py) to a store in root.
+    """
+    data = np.load(npz_path)
+    latents = data["latents"]
+    latents = latents.reshape(-1, *latents.shape[-3:])
+    labels = data["labels"]
+    labels = labels.reshape(-1, *labels.shape[-2:])
+
+    writer = LatentStoreWriter(root, chunk_size=chunk_size, label_dtype=label_dtype)
+    for start in range(0, len(latents), chunk_size):
+        writer.append(latents[start:start+chunk_size], labels[start:start+chunk_size])
+    writer.close()
+    return writer
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("npz_path")
+    parser.add_argument("root")
+    parser.add_argument("--chunk_size", type=int, default=1024)
+    parser.add_argument("--label_dtype", default=None, help="e.g. float16 to halve the size of the labels")
+    args = parser.parse_args()
+
+    writer = convert_npz(args.npz_path, args.root, args.chunk_size, args.label_dtype)
+    print(f"{len(writer)} samples in {len(writer.index['shards'])} shards")
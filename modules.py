@@ -1,17 +1,51 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 
 class EMA:
-    def __init__(self, beta):
+    def __init__(self, beta, update_every=1):
         super().__init__()
         self.beta = beta
+        ## Update the average every update_every steps (with beta ** update_every)
+        self.update_every = update_every
         self.step = 0
+        self.tensors = None
+
+    def model_tensors(self, ma_model, current_model):
+        """
+        Tensors of the state of the two models (parameters and persistent buffers),
+        the floating point ones are averaged and the others copied. The lists are
+        cached, so the updates don't walk the modules at each step.
+        """
+        key = (id(ma_model), id(current_model))
+        if self.tensors is None or self.tensors[0] != key:
+            ma_state = ma_model.state_dict(keep_vars=True)
+            current_state = current_model.state_dict(keep_vars=True)
+            averaged = [name for name in ma_state if ma_state[name].is_floating_point()]
+            copied = [name for name in ma_state if not ma_state[name].is_floating_point()]
+            self.tensors = (key,
+                            [ma_state[name].data for name in averaged], [current_state[name].data for name in averaged],
+                            [ma_state[name].data for name in copied], [current_state[name].data for name in copied])
+        return self.tensors[1:]
+
+    def copy_tensors(self, targets, sources):
+        if not targets:
+            return
+        if hasattr(torch, "_foreach_copy_"):
+            torch._foreach_copy_(targets, sources)
+        else:
+            for target, source in zip(targets, sources):
+                target.copy_(source)
 
+    @torch.no_grad()
     def update_model_average(self, ma_model, current_model):
-        for current_params, ma_params in zip(current_model.parameters(), ma_model.parameters()):
-            old_weight, up_weight = ma_params.data, current_params.data
-            ma_params.data = self.update_average(old_weight, up_weight)
+        ma_params, current_params, ma_others, current_others = self.model_tensors(ma_model, current_model)
+        beta = self.beta ** self.update_every
+        ## In place ma = beta * ma + (1 - beta) * current, in a few fused kernels
+        torch._foreach_mul_(ma_params, beta)
+        torch._foreach_add_(ma_params, current_params, alpha=1 - beta)
+        self.copy_tensors(ma_others, current_others)
 
     def update_average(self, old, new):
         if old is None:
@@ -19,21 +53,37 @@ class EMA:
         return old * self.beta + (1 - self.beta) * new
 
     def step_ema(self, ema_model, model, step_start_ema=37632):
-        if self.step < step_start_ema:
-            self.reset_parameters(ema_model, model)
-            self.step += 1
-            return
-        self.update_model_average(ema_model, model)
+        if self.step % self.update_every == 0:
+            if self.step < step_start_ema:
+                self.reset_parameters(ema_model, model)
+            else:
+                self.update_model_average(ema_model, model)
         self.step += 1
 
+    @torch.no_grad()
     def reset_parameters(self, ema_model, model):
-        ema_model.load_state_dict(model.state_dict())
+        ma_params, current_params, ma_others, current_others = self.model_tensors(ema_model, model)
+        self.copy_tensors(ma_params, current_params)
+        self.copy_tensors(ma_others, current_others)
 
 class SelfAttention(nn.Module):
-    def __init__(self, channels, size):
+    """
+    Self attention over the pixels. The backend computes the attention of the
+    nn.MultiheadAttention weights (so every backend loads the same checkpoints):
+    "mha" nn.MultiheadAttention, "sdpa" scaled_dot_product_attention (flash or
+    memory efficient kernels on GPU, chunked queries on CPU), "chunked" the
+    queries in chunks of chunk_size and "window" local attention in windows of
+    window x window pixels (an approximation, for large latents).
+    """
+    def __init__(self, channels, size, backend="mha", chunk_size=1024, window=7):
         super(SelfAttention, self).__init__()
+        if backend not in ("mha", "sdpa", "chunked", "window"):
+            raise ValueError(f"Unknown attention backend {backend}")
         self.channels = channels
         self.size = size
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self.window = window
         self.mha = nn.MultiheadAttention(channels, 2, batch_first=True)
         self.ln = nn.LayerNorm([channels])
         self.ff_self = nn.Sequential(
@@ -43,10 +93,48 @@ class SelfAttention(nn.Module):
             nn.Linear(channels, channels),
         )
 
+    def chunked_attention(self, q, k, v):
+        return torch.cat([F.scaled_dot_product_attention(q[:, :, i:i+self.chunk_size], k, v)
+                          for i in range(0, q.shape[2], self.chunk_size)], dim=2)
+
+    def window_attention(self, q, k, v):
+        n, heads, _, d = q.shape
+        w = self.window
+        g = int(self.size) // w
+
+        ## (n, heads, size*size, d) -> (n, heads*g*g, w*w, d) with the pixels of each window
+        def to_windows(z):
+            z = z.reshape(n, heads, g, w, g, w, d).permute(0, 1, 2, 4, 3, 5, 6)
+            return z.reshape(n, heads * g * g, w * w, d)
+
+        out = F.scaled_dot_product_attention(to_windows(q), to_windows(k), to_windows(v))
+        out = out.reshape(n, heads, g, g, w, w, d).permute(0, 1, 2, 4, 3, 5, 6)
+        return out.reshape(n, heads, g * w * g * w, d)
+
+    def attention(self, x):
+        n, l, c = x.shape
+        heads = self.mha.num_heads
+
+        q, k, v = F.linear(x, self.mha.in_proj_weight, self.mha.in_proj_bias).chunk(3, dim=-1)
+        q, k, v = [z.reshape(n, l, heads, c // heads).transpose(1, 2) for z in (q, k, v)]
+
+        if self.backend == "window" and int(self.size) % self.window == 0 and int(self.size) > self.window:
+            out = self.window_attention(q, k, v)
+        elif self.backend == "chunked" or (self.backend == "sdpa" and x.device.type == "cpu"):
+            out = self.chunked_attention(q, k, v)
+        else:
+            out = F.scaled_dot_product_attention(q, k, v)
+
+        out = out.transpose(1, 2).reshape(n, l, c)
+        return self.mha.out_proj(out)
+
     def forward(self, x):
         x = x.view(-1, self.channels, int(self.size) * int(self.size)).swapaxes(1, 2)
         x_ln = self.ln(x)
-        attention_value, _ = self.mha(x_ln, x_ln, x_ln)
+        if self.backend == "mha":
+            attention_value, _ = self.mha(x_ln, x_ln, x_ln)
+        else:
+            attention_value = self.attention(x_ln)
         attention_value = attention_value + x
         attention_value = self.ff_self(attention_value) + attention_value
         return attention_value.swapaxes(2, 1).view(-1, self.channels, int(self.size), int(self.size))
@@ -94,7 +182,7 @@ class Down(nn.Module):
 
     def forward(self, x, t):
         x = self.maxpool_conv(x)
-        emb = self.emb_layer(t)[:, :, None, None].repeat(1, 1, x.shape[-2], x.shape[-1])
+        emb = self.emb_layer(t)[:, :, None, None]
         return x + emb
     
 class Up(nn.Module):
@@ -120,20 +208,33 @@ class Up(nn.Module):
         x = self.up(x)
         x = torch.cat([skip_x, x], dim=1)
         x = self.conv(x)
-        emb = self.emb_layer(t)[:, :, None, None].repeat(1, 1, x.shape[-2], x.shape[-1])
+        emb = self.emb_layer(t)[:, :, None, None]
         return x + emb
 
 class UNet_conditional(nn.Module):
-    def __init__(self, c_in=3, c_out=384, time_dim=256, device="cuda", max_ch_deep=512, img_size=8, net_dimension=256):
+    def __init__(self, c_in=3, c_out=384, time_dim=256, device="cuda", max_ch_deep=512, img_size=8, net_dimension=256, learned_null=False, cond_shape=(50, 768), checkpoint_blocks=None, attention_backend="mha"):
         super().__init__()
         self.device = device
         self.time_dim = time_dim
+        ## Names of the blocks (e.g. {"sa1", "sa5", "sa6"}) recomputed in the backward
+        ## instead of storing their activations, only while training
+        self.checkpoint_blocks = set(checkpoint_blocks or ())
+
+        ## Null condition (ViT tokens) used by the classifier free guidance,
+        ## learned when the model is trained with condition dropout
+        if learned_null:
+            self.null_cond = nn.Parameter(torch.zeros(1, *cond_shape))
+        else:
+            self.register_buffer("null_cond", torch.zeros(1, *cond_shape), persistent=False)
+
+        ## Positional encodings of all the diffusion steps (see prepare_inference)
+        self.register_buffer("time_table", None, persistent=False)
         
         self.inc = DoubleConv(48+c_out, net_dimension*2)
-        self.down1 = Down(net_dimension*2, net_dimension*4)
-        self.sa1 = SelfAttention(net_dimension*4, img_size//2)
-        self.down2 = Down(192+net_dimension*4, net_dimension*8)
-        self.sa2 = SelfAttention(net_dimension*8, img_size//4)
+        self.down1 = Down(net_dimension*2, net_dimension*4, emb_dim=time_dim)
+        self.sa1 = SelfAttention(net_dimension*4, img_size//2, backend=attention_backend)
+        self.down2 = Down(192+net_dimension*4, net_dimension*8, emb_dim=time_dim)
+        self.sa2 = SelfAttention(net_dimension*8, img_size//4, backend=attention_backend)
         # self.down3 = Down(768+net_dimension*8, net_dimension*8)
         # self.sa3 = SelfAttention(net_dimension*8, img_size//8)
         
@@ -144,14 +245,18 @@ class UNet_conditional(nn.Module):
 
         # self.up1 = Up(net_dimension*8, net_dimension*4)
         # self.sa4 = SelfAttention(net_dimension*4, img_size//2)
-        self.up2 = Up(net_dimension*8, net_dimension*2)
-        self.sa5 = SelfAttention(net_dimension*2, img_size//2)
-        self.up3 = Up(net_dimension*4, net_dimension*2)
-        self.sa6 = SelfAttention(net_dimension*2, img_size)
+        self.up2 = Up(net_dimension*8, net_dimension*2, emb_dim=time_dim)
+        self.sa5 = SelfAttention(net_dimension*2, img_size//2, backend=attention_backend)
+        self.up3 = Up(net_dimension*4, net_dimension*2, emb_dim=time_dim)
+        self.sa6 = SelfAttention(net_dimension*2, img_size, backend=attention_backend)
         self.outc = nn.Sequential(
             nn.Conv2d(net_dimension*2, c_out, kernel_size=1)
         )
 
+        unknown_blocks = self.checkpoint_blocks - {name for name, _ in self.named_children()}
+        if unknown_blocks:
+            raise ValueError(f"Unknown checkpoint_blocks {sorted(unknown_blocks)}, use blocks of {[name for name, _ in self.named_children()]}")
+
     def pos_encoding(self, t, channels):
         inv_freq = 1.0 / (
             10000
@@ -162,9 +267,68 @@ class UNet_conditional(nn.Module):
         pos_enc = torch.cat([pos_enc_a, pos_enc_b], dim=-1)
         return pos_enc
 
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        """
+        The checkpoints with and without a learned null condition load in both
+        models: a missing null_cond keeps the zero condition and a learned one
+        is copied to the buffer.
+        """
+        key = prefix + "null_cond"
+        if isinstance(self.null_cond, nn.Parameter):
+            if key not in state_dict:
+                state_dict[key] = self.null_cond.detach().clone()
+        elif key in state_dict:
+            with torch.no_grad():
+                self.null_cond.copy_(state_dict.pop(key))
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+
+    def prepare_inference(self, noise_steps):
+        """
+        Precompute the positional encoding of every diffusion step, the
+        forward then only indexes the table.
+        """
+        if self.time_table is None or self.time_table.shape[0] != noise_steps:
+            t = torch.arange(noise_steps, device=self.null_cond.device).unsqueeze(-1).float()
+            self.time_table = self.pos_encoding(t, self.time_dim)
+
+    def encode_condition(self, y):
+        """
+        Reshape the ViT labels to the two resolutions concatenated to the
+        latents, it can be computed once and passed as y to the forward.
+        """
+        y = y[:, :-1]
+        return y.reshape(-1, 48, 28, 28), y.reshape(-1, 192, 14, 14)
+
+    def drop_condition(self, y, p):
+        """
+        Replace a random fraction p of the conditions by the null condition,
+        to train the unconditional model of the classifier free guidance.
+        """
+        mask = torch.rand(y.shape[0], device=y.device) < p
+        return torch.where(mask[:, None, None], self.null_cond.to(y.dtype), y)
+
+    def block(self, name, *inputs):
+        """
+        Run the block name, with activation checkpointing if it is in checkpoint_blocks.
+        """
+        module = getattr(self, name)
+        if name in self.checkpoint_blocks and self.training and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(module, *inputs, use_reentrant=False)
+        return module(*inputs)
+
     def forward(self, x, t, y):
-        t = t.unsqueeze(-1).type(torch.float)
-        t = self.pos_encoding(t, self.time_dim)
+        if y is None:
+            y = self.null_cond.expand(x.shape[0], -1, -1)
+
+        if torch.is_tensor(y):
+            y = self.encode_condition(y)
+        y_28, y_14 = y
+
+        if self.time_table is not None:
+            t = self.time_table[t]
+        else:
+            t = t.unsqueeze(-1).type(torch.float)
+            t = self.pos_encoding(t, self.time_dim)
         # if y is not None:
         #     t += torch.flatten(y[:,:25], start_dim=1)
 
@@ -172,26 +336,26 @@ class UNet_conditional(nn.Module):
         # color = y.view(-1, 1536, 5, 5)
         # color = torch.nn.functional.pad(color, (0, 2, 0, 2), "constant", 0)
 
-        x1 = self.inc(torch.cat((x, y[:, :-1].view(-1, 48, 28, 28)),1))
-        x2 = self.down1(x1, t)
-        x2 = self.sa1(x2)
-        x3 = self.down2(torch.cat((x2, y[:, :-1].view(-1, 192, 14, 14)), 1), t)
-        x3 = self.sa2(x3)
+        x1 = self.block("inc", torch.cat((x, y_28),1))
+        x2 = self.block("down1", x1, t)
+        x2 = self.block("sa1", x2)
+        x3 = self.block("down2", torch.cat((x2, y_14), 1), t)
+        x3 = self.block("sa2", x3)
         # x4 = self.down3(torch.cat((x3, y[:, :-1].view(-1, 768, 7, 7)), 1), t)
         # x4 = self.sa3(x4)   
 
-        x4 = self.bot1(x3)
+        x4 = self.block("bot1", x3)
         # x4 = self.bot2(torch.sum(torch.stack([color, x4]), dim=0))
         # x4 = self.bot2(torch.cat((color, x4), 1))
-        x4 = self.bot3(x4)
+        x4 = self.block("bot3", x4)
         # x4 = self.bot3(x4)
 
         # x = self.up1(x4, x2, t)
         # x = self.sa4(x)
-        x = self.up2(x4, x2, t)
-        x = self.sa5(x)
-        x = self.up3(x, x1, t)
-        x = self.sa6(x)
+        x = self.block("up2", x4, x2, t)
+        x = self.block("sa5", x)
+        x = self.block("up3", x, x1, t)
+        x = self.block("sa6", x)
         
         output = self.outc(x)
         return output
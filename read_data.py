@@ -1,12 +1,115 @@
 import os
 import torch
 import torchvision
+import torch.nn as nn
 from torchvision import transforms
-from torch.utils.data import Dataset, DataLoader, SubsetRandomSampler, ConcatDataset
+from torch.utils.data import Dataset, DataLoader, SubsetRandomSampler, ConcatDataset, default_collate
 import kornia as K
 from utils import *
+import json
 import random
+import multiprocessing
 import numpy as np
+from collections import OrderedDict
+from torchvision.datasets.folder import default_loader
+from latent_store import LatentStore, is_latent_store
+from frame_pack import FramePack, is_frame_pack
+
+class FrameCache():
+    """
+    Bounded LRU cache of decoded frames, keyed by the path of the frame.
+    Each DataLoader worker has its own copy of the dataset, so the cache is
+    per worker. The hits and misses of each process (main process and
+    workers) are counted in shared memory, so stats() in the main process
+    also has the counts of the workers. max_items=0 disables the cache.
+    """
+
+    def __init__(self, max_items=512, max_workers=64) -> None:
+        self.max_items = max_items
+        self.max_workers = max_workers
+        self.items = OrderedDict()
+        # (hits, misses) of the main process and of each worker
+        self.counts = multiprocessing.RawArray("q", 2 * (max_workers + 1))
+
+    def slot(self):
+        """
+        Index of the counts of this process (0 in the main process).
+        """
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            return 0
+        return 2 * (worker_info.id % self.max_workers + 1)
+
+    def get(self, key, load):
+        """
+        Return the frame of key, calling load(key) when it is not cached.
+        """
+        slot = self.slot()
+        if key in self.items:
+            self.counts[slot] += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+        self.counts[slot + 1] += 1
+        value = load(key)
+        if self.max_items > 0:
+            self.items[key] = value
+            if len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+        return value
+
+    def stats(self):
+        """
+        Hits and misses of all the processes, and the hit rate of each one
+        ("main" and the id of each worker).
+        """
+        hits, misses = sum(self.counts[0::2]), sum(self.counts[1::2])
+        processes = {}
+        for worker in range(self.max_workers + 1):
+            worker_hits, worker_misses = self.counts[2 * worker], self.counts[2 * worker + 1]
+            if worker_hits + worker_misses:
+                processes["main" if worker == 0 else worker - 1] = worker_hits / (worker_hits + worker_misses)
+        return {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else 0., "hit_rate_by_process": processes}
+
+class BatchAugmentation(nn.Module):
+    """
+    Transform of ColorizationDataset applied on batches of uint8 frames
+    (see batch_augment), with kornia: with train the random crop and
+    rotation are drawn for each frame, then the frames are normalized.
+    """
+
+    def __init__(self, image_size, train=None):
+        super().__init__()
+        if train:
+            self.augment = nn.Sequential(
+                K.augmentation.RandomResizedCrop((image_size, image_size), scale=(0.8, 1.0)),
+                K.augmentation.RandomRotation(degrees=(0., 365.), p=1.0),
+            )
+        else:
+            self.augment = nn.Identity()
+
+    def forward(self, x):
+        x = self.augment(x.float() / 255)
+        return (x - 0.5) / 0.5
+
+class BatchTransformCollate():
+    """
+    Collate function that apply transform to the batches of uint8 frames
+    after the default collate (the other fields are unchanged).
+    """
+
+    def __init__(self, transform) -> None:
+        self.transform = transform
+
+    def apply(self, data):
+        if torch.is_tensor(data) and data.dtype == torch.uint8 and data.dim() == 4:
+            return self.transform(data)
+        if isinstance(data, (list, tuple)):
+            return type(data)(self.apply(d) for d in data)
+        return data
+
+    def __call__(self, batch):
+        return self.apply(default_collate(batch))
 
 class ColorizationDataset(Dataset):
     """
@@ -14,25 +117,57 @@ class ColorizationDataset(Dataset):
     divided in subfoldes for each scene or video.
     The return is a list with 3 elements, frames to ve colorized,
     the direclety next frames in the video sequence and example image with color.
+    The decoded and resized frames are kept in a LRU cache (cache_size frames),
+    before the random augmentation, so the next frames and keyframes
+    are read from memory.
+    With batch_augment the frames are returned as uint8 tensors and the
+    augmentation and normalization are done in batches by BatchAugmentation.
     """
 
-    def __init__(self, path, image_size, constrative=False, train=None):
+    def __init__(self, path, image_size, constrative=False, train=None, cache_size=512, batch_augment=False):
         super(Dataset, self).__init__()
 
         self.path = path
         self.image_size = image_size
         self.constrative = constrative
         self.train = train
+        self.batch_augment = batch_augment
 
         self.scenes = os.listdir(path)
 
-        self.dataset = torchvision.datasets.ImageFolder(self.path, self.__transform__)
+        self.cache = FrameCache(cache_size)
+        self.dataset = torchvision.datasets.ImageFolder(self.path, self.__transform__, loader=self.__load_frame__)
+
+    def __base_transform__(self, x):
+        """
+        Deterministic resize of the frames, applied before the cache.
+        """
+        if self.train and self.batch_augment:
+            # Same size for all the frames, to be collated before the augmentation
+            return torchvision.transforms.Resize((280, 280))(x)
+        if self.train:
+            return torchvision.transforms.Resize(280)(x)  # args.image_size + 1/4 *args.image_size
+        return transforms.Resize((self.image_size, self.image_size))(x)
+
+    def __decode__(self, path):
+        return self.__base_transform__(default_loader(path))
+
+    def __load_frame__(self, path):
+        return self.cache.get(path, self.__decode__)
+
+    def cache_stats(self):
+        """
+        Hit rate of the frame cache, of the main process and the DataLoader workers.
+        """
+        return self.cache.stats()
 
     def __colorization_transform__(self, x):
 
+        if self.batch_augment:
+            return transforms.PILToTensor()(x)
+
         if self.train:
             colorization_transform=transforms.Compose([
-                    torchvision.transforms.Resize(280),  # args.image_size + 1/4 *args.image_size
                     torchvision.transforms.RandomResizedCrop(self.image_size, scale=(0.8, 1.0)),
                     torchvision.transforms.RandomRotation((0, 365)),
                     transforms.Resize((self.image_size,self.image_size)),
@@ -41,7 +176,6 @@ class ColorizationDataset(Dataset):
                 ])
         else:
             colorization_transform=transforms.Compose([
-                transforms.Resize((self.image_size, self.image_size)),
                 transforms.ToTensor(),
                 transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
                 ])
@@ -81,6 +215,146 @@ class ColorizationDataset(Dataset):
             return self.dataset[index], self.dataset[keyframe_index], self.dataset[next_index]
         
 
+class FramePackDataset(Dataset):
+    """
+    The same samples of ColorizationDataset read from a frame pack (see
+    frame_pack.py), a frame is a slice of the memory mapped pack, without
+    JPEG decoding. The keyframe is one of the first 10 frames of the scene
+    and the next frame never crosses the end of the scene.
+    With batch_augment the frames are returned as uint8 tensors (see BatchAugmentation).
+    """
+
+    def __init__(self, path, image_size, constrative=False, train=None, batch_augment=False):
+        super(Dataset, self).__init__()
+
+        self.path = path
+        self.image_size = image_size
+        self.constrative = constrative
+        self.train = train
+        self.batch_augment = batch_augment
+
+        self.pack = FramePack(path)
+        self.scenes = self.pack.classes
+
+        if train:
+            self.transform = transforms.Compose([
+                transforms.RandomResizedCrop(self.image_size, scale=(0.8, 1.0), antialias=True),
+                transforms.RandomRotation((0, 365)),
+                transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
+            ])
+        else:
+            self.transform = transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
+
+    def __len__(self):
+        """
+        Return hou much samples as in the dataset.
+        """
+        return len(self.pack)
+
+    def frame(self, index):
+        """
+        Return the transformed frame index and its scene.
+        """
+        x = torch.from_numpy(np.array(self.pack[index])).permute(2, 0, 1)
+        if not self.train and x.shape[-1] != self.image_size:
+            x = transforms.functional.resize(x, [self.image_size, self.image_size], antialias=True)
+        if not self.batch_augment:
+            x = self.transform(x.float() / 255)
+        return x, int(self.pack.targets[index])
+
+    def __getitem__(self, index):
+        """
+        Return the frames that will be colorized, the next frames and 
+        the color example frame (first of the sequence).
+        """
+        # Get the next indices, inside the scene of the frame
+        _, start, end = self.pack.scene_range(index)
+        keyframe_index = start + random.randint(0, min(10, end - start - 1))
+        next_index = min(index + 1, end - 1)
+
+        if self.constrative:
+            random_idx = random.randint(20, 100)
+            random_idx = min(random_idx + 1, len(self.pack) - 1)
+            return self.frame(index), self.frame(keyframe_index), self.frame(next_index), self.frame(random_idx)
+        else:
+            return self.frame(index), self.frame(keyframe_index), self.frame(next_index)
+
+def scene_ranges(targets):
+    """
+    Return the (start, end) of each scene, from the scene of each frame
+    (the frames of a scene are contiguous, as in ImageFolder).
+    """
+    ranges = []
+    start = 0
+    for index in range(1, len(targets) + 1):
+        if index == len(targets) or targets[index] != targets[start]:
+            ranges.append((start, index))
+            start = index
+    return ranges
+
+class ClipDataset(Dataset):
+    """
+    This class create a dataset of clips, contiguous windows of clip_length
+    frames of the same scene (a subfolder of path, or a scene of a frame pack).
+    Each item return the clip (clip_length x 3 x H x W), a keyframe (one of the
+    first 10 frames of the scene) and the index of the scene. With train the
+    same random crop and rotation is applied to all the frames of the item.
+    stride: distance between the first frames of two clips (default clip_length).
+    """
+
+    def __init__(self, path, image_size, clip_length=8, stride=None, train=None, cache_size=512):
+        super(Dataset, self).__init__()
+
+        self.path = path
+        self.image_size = image_size
+        self.clip_length = clip_length
+        self.train = train
+
+        ## Frames as uint8 tensors, transformed by clip
+        if is_frame_pack(path):
+            self.frames = FramePackDataset(path, image_size, train=train, batch_augment=True)
+            self.load_frame = self.frames.frame
+            targets = self.frames.pack.targets
+        else:
+            self.frames = ColorizationDataset(path, image_size, train=train, cache_size=cache_size, batch_augment=True).dataset
+            self.load_frame = self.frames.__getitem__
+            targets = self.frames.targets
+
+        ## Clips of each scene, a scene shorter than clip_length has no clip
+        self.scene_ranges = scene_ranges(targets)
+        stride = stride or clip_length
+        self.clips = [(scene, clip_start) for scene, (start, end) in enumerate(self.scene_ranges) for clip_start in range(start, end - clip_length + 1, stride)]
+
+        if train:
+            self.transform = transforms.Compose([
+                transforms.RandomResizedCrop(self.image_size, scale=(0.8, 1.0), antialias=True),
+                transforms.RandomRotation((0, 365)),
+                transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
+            ])
+        else:
+            self.transform = transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
+
+    def __len__(self):
+        """
+        Return hou much clips as in the dataset.
+        """
+        return len(self.clips)
+
+    def __getitem__(self, index):
+        """
+        Return the clip, the keyframe of its scene and the scene index.
+        """
+        scene, clip_start = self.clips[index]
+        start, end = self.scene_ranges[scene]
+        keyframe_index = start + random.randint(0, min(10, end - start - 1))
+
+        frames = [self.load_frame(i)[0] for i in range(clip_start, clip_start + self.clip_length)]
+        frames.append(self.load_frame(keyframe_index)[0])
+
+        # The transform draws one set of random parameters for all the frames
+        frames = self.transform(torch.stack(frames).float() / 255)
+        return frames[:-1], frames[-1], scene
+
 class LatentsDataset(Dataset):
     """
     This class create a dataset from a path, where the data must be where
@@ -118,6 +392,64 @@ class LatentsDataset(Dataset):
         last_index = min(index + 1, len(self.latents) - 1)
         return self.latents[index].squeeze(), self.labels[index].squeeze(), self.latents[last_index].squeeze()
 
+class ShardedLatentsDataset(Dataset):
+    """
+    The same samples of LatentsDataset read from a sharded latent store
+    (see latent_store.py), the shards are memory mapped so nothing is
+    loaded in RAM and __getitem__ return views of the mapped files.
+    The labels stored as float16 are returned as float32.
+    """
+
+    def __init__(self, path):
+        super(Dataset, self).__init__()
+
+        self.path = path
+        self.store = LatentStore(path)
+
+    def __len__(self):
+        """
+        Return hou much samples as in the dataset.
+        """
+        return len(self.store)
+
+    def __getitem__(self, index):
+        """
+        Return the latents, the labels and the next latents.
+        """
+        last_index = min(index + 1, len(self.store) - 1)
+        latents, labels = self.store[index]
+        next_latents, _ = self.store[last_index]
+        return latents, np.asarray(labels, dtype=np.float32), next_latents
+
+def latents_dataset(path, file_name="latent.npz"):
+    """
+    Return the dataset of the latents of path, a ShardedLatentsDataset
+    when path is a latent store and a LatentsDataset otherwise.
+    """
+    if is_latent_store(path):
+        return ShardedLatentsDataset(path)
+    return LatentsDataset(path, file_name)
+
+def loader_kwargs(loader_config=None, pin_memory=True):
+    """
+    DataLoader arguments of a loader config (a dict or the path of the json
+    written by "python benchmark.py dataloader"), with num_workers, pin_memory,
+    persistent_workers and prefetch_factor. Without config the data is
+    loaded in the main process.
+    """
+    if loader_config is None:
+        return {"pin_memory": pin_memory}
+    if isinstance(loader_config, str):
+        with open(loader_config) as f:
+            loader_config = json.load(f)
+
+    kwargs = {"num_workers": loader_config.get("num_workers", 0), "pin_memory": loader_config.get("pin_memory", pin_memory)}
+    # Only valid with worker processes
+    if kwargs["num_workers"] > 0:
+        kwargs["persistent_workers"] = loader_config.get("persistent_workers", True)
+        kwargs["prefetch_factor"] = loader_config.get("prefetch_factor", 2)
+    return kwargs
+
 # Create the dataset
 class ReadData():
 
@@ -125,15 +457,38 @@ class ReadData():
     def __init__(self) -> None:
         super().__init__()
 
-    def create_dataLoader(self, dataroot, image_size, batch_size=16, shuffle=False, pin_memory=True, constrative=False , train=None):
+    def create_dataLoader(self, dataroot, image_size, batch_size=16, shuffle=False, pin_memory=True, constrative=False , train=None, cache_size=512, batch_augment=False, loader_config=None):
+        """
+        dataroot: folder with a subfolder of frames for each scene, or a frame pack (see frame_pack.py).
+        batch_augment: augment and normalize the frames in batches (after the collate)
+        instead of one by one with PIL.
+        loader_config: workers settings of the DataLoader (see loader_kwargs).
+        """
+
+        if is_frame_pack(dataroot):
+            self.datas = FramePackDataset(dataroot, image_size, constrative=constrative, train=train, batch_augment=batch_augment)
+        else:
+            self.datas = ColorizationDataset(dataroot, image_size, constrative=constrative, train=train, cache_size=cache_size, batch_augment=batch_augment)
 
-        self.datas = ColorizationDataset(dataroot, image_size, constrative=constrative, train=train)
+        collate_fn = None
+        if batch_augment:
+            collate_fn = BatchTransformCollate(BatchAugmentation(image_size, train=train))
 
         # self.datas = DAVISDataset(dataroot, image_size, rgb=rgb, pos_path=pos_path, constrative=constrative)
-        self.dataloader = torch.utils.data.DataLoader(self.datas, batch_size=batch_size, shuffle=shuffle, pin_memory=pin_memory)
+        self.dataloader = torch.utils.data.DataLoader(self.datas, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_fn, **loader_kwargs(loader_config, pin_memory))
 
         # assert (next(iter(self.dataloader))[0][0].shape) == (next(iter(self.dataloader))[1].shape), "The shapes must be the same"
         return self.dataloader
+
+    def create_clip_dataLoader(self, dataroot, image_size, clip_length=8, batch_size=16, shuffle=False, pin_memory=True, train=None, stride=None, cache_size=512):
+        """
+        Dataloader of clips of clip_length contiguous frames of a scene (see ClipDataset).
+        """
+        self.datas = ClipDataset(dataroot, image_size, clip_length=clip_length, stride=stride, train=train, cache_size=cache_size)
+        self.dataloader = torch.utils.data.DataLoader(self.datas, batch_size=batch_size, shuffle=shuffle, pin_memory=pin_memory)
+
+        return self.dataloader
+
     
 class ReadLatent():
 
@@ -142,22 +497,25 @@ class ReadLatent():
         super().__init__()
         self. file_name=file_name
 
-    def create_dataLoader(self, dataroot, batch_size, shuffle=False, pin_memory=True, valid_dataroot=None):
+    def create_dataLoader(self, dataroot, batch_size, shuffle=False, pin_memory=True, valid_dataroot=None, loader_config=None):
+        """
+        loader_config: workers settings of the DataLoader (see loader_kwargs).
+        """
 
         if valid_dataroot:
 
             ## Crea the Datasets
-            self.train_datas = LatentsDataset(dataroot, self.file_name)
-            self.valid_datas = LatentsDataset(valid_dataroot, self.file_name)
+            self.train_datas = latents_dataset(dataroot, self.file_name)
+            self.valid_datas = latents_dataset(valid_dataroot, self.file_name)
             
             ## Concatenate the datasets
             self.datas = ConcatDataset([self.train_datas, self.valid_datas])
 
         else:
-            self.datas = LatentsDataset(dataroot, self.file_name)
+            self.datas = latents_dataset(dataroot, self.file_name)
 
         # self.datas = DAVISDataset(dataroot, image_size, rgb=rgb, pos_path=pos_path, constrative=constrative)
-        self.dataloader = torch.utils.data.DataLoader(self.datas, batch_size=batch_size, shuffle=shuffle, pin_memory=pin_memory)
+        self.dataloader = torch.utils.data.DataLoader(self.datas, batch_size=batch_size, shuffle=shuffle, **loader_kwargs(loader_config, pin_memory))
 
         # assert (next(iter(self.dataloader))[0][0].shape) == (next(iter(self.dataloader))[1].shape), "The shapes must be the same"
         return self.dataloader
@@ -167,14 +525,14 @@ class ReadLatent():
         if valid_dataroot:
 
             ## Crea the Datasets
-            self.train_datas = LatentsDataset(dataroot)
-            self.valid_datas = LatentsDataset(valid_dataroot)
+            self.train_datas = latents_dataset(dataroot, self.file_name)
+            self.valid_datas = latents_dataset(valid_dataroot, self.file_name)
             
             ## Concatenate the datasets
             self.datas = ConcatDataset([self.train_datas, self.valid_datas])
 
         else:
-            self.datas = LatentsDataset(dataroot)
+            self.datas = latents_dataset(dataroot, self.file_name)
         
         return self.datas
 
@@ -1,33 +1,40 @@
-# Logger
-import comet_ml
-
 # Imports
 import torch
 import os
 import copy
+import time
+import random
+import numpy as np
 from utils import *
 from ddpm import Diffusion, UNet_conditional
 import read_data as ld
 from tqdm import tqdm
 import logging
 from torch import optim
-import VAE as vae
 from modules import EMA
 from torch.utils.data import DataLoader, SubsetRandomSampler
 import torch.nn as nn
-from ViT import Vit_neck
 
 def checkpoint(model, filename):
     torch.save(model.state_dict(), filename)
 
 class TrainDiffusion():
-    def __init__(self, dataroot, valid_dataroot, image_size, time_dim) -> None:
+    def __init__(self, dataroot, valid_dataroot, image_size, time_dim, cond_drop_prob=0., loader_config=None, precision="auto", micro_batch_size=None) -> None:
 
         self.dataroot = dataroot
         self.image_size = image_size
         self.time_dim = time_dim
         self.run_name = get_model_time()
         self.valid_dataroot = valid_dataroot
+        ## Probability to replace the labels by the null condition (classifier free guidance)
+        self.cond_drop_prob = cond_drop_prob
+        ## Workers settings of the DataLoaders (see read_data.loader_kwargs)
+        self.loader_config = loader_config
+        ## Mixed precision: "fp32", "bf16", "fp16" or "auto" (bf16 on CPU, fp16 on GPU)
+        self.precision = precision
+        ## Samples in memory by forward/backward (None is the whole batch), the
+        ## gradients of the micro batches are accumulated to a step of the batch
+        self.micro_batch_size = micro_batch_size
 
     def read_datalaoder(self):
         """
@@ -58,29 +65,74 @@ class TrainDiffusion():
         criterion = criterion.to(device)
         return criterion
     
-    def train_epoch(self, diffusion, diffusion_model, device, dataloader, criterion, optimizer, ema, ema_model):
+    def amp_dtype(self, device):
+        """
+        Return the autocast dtype of the precision policy (None for fp32).
+        """
+        device_type = torch.device(device).type
+        precision = self.precision
+        if precision == "auto":
+            precision = "fp16" if device_type == "cuda" else "bf16"
+        if precision not in ("fp32", "bf16", "fp16"):
+            raise ValueError(f"Unknown precision {precision}")
+        if precision == "fp16" and device_type != "cuda":
+            raise ValueError("fp16 training needs a cuda device, use bf16")
+        return {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}[precision]
+
+    def autocast(self, device):
+        """
+        Autocast context of the forward and the loss, the weights stay in fp32.
+        """
+        dtype = self.amp_dtype(device)
+        return torch.autocast(device_type=torch.device(device).type, dtype=dtype, enabled=dtype is not None)
+
+    def create_scaler(self, device):
+        """
+        Loss scaler, only enabled with fp16 (bf16 has the range of fp32).
+        """
+        return torch.cuda.amp.GradScaler(enabled=self.amp_dtype(device) == torch.float16)
+
+    def train_epoch(self, diffusion, diffusion_model, device, dataloader, criterion, optimizer, ema, ema_model, scaler=None):
+        if scaler is None:
+            scaler = self.create_scaler(device)
+
         diffusion_model.train()
-        for latents, labels, _ in dataloader:
+        for batch_latents, batch_labels, _ in dataloader:
 
-            latents=latents.to(device)
-            labels=labels.to(device)
+            l = batch_latents.shape[0]
 
-            l = latents.shape[0]
+            ### Gradient accumulation over micro batches, the loss of each one
+            ### is weighted by its share of the batch
+            micro_batch_size = self.micro_batch_size or l
+            optimizer.zero_grad()
+            loss = 0
+            for latents, labels in zip(batch_latents.split(micro_batch_size), batch_labels.split(micro_batch_size)):
 
-            ### Generate the noise using the ground truth image
-            t = diffusion.sample_timesteps(latents.shape[0]).to(device)
-            x_t, noise = diffusion.noise_images(latents, t)
+                latents=latents.to(device)
+                labels=labels.to(device)
 
-            ### Predict the noise 
-            predicted_noise = diffusion_model(x_t, t, labels).half()
+                ### Condition dropout to learn the null condition
+                cond_labels = labels
+                if self.cond_drop_prob > 0:
+                    cond_labels = diffusion_model.drop_condition(labels, self.cond_drop_prob)
 
-            ### Meansure the difference between noise predicted and realnoise
-            with torch.autocast(device_type=device):
-                loss = criterion(predicted_noise, noise)
+                ### Generate the noise using the ground truth image
+                t = diffusion.sample_timesteps(latents.shape[0]).to(device)
+                x_t, noise = diffusion.noise_images(latents, t)
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+                with self.autocast(device):
+                    ### Predict the noise 
+                    predicted_noise = diffusion_model(x_t, t, cond_labels)
+
+                    ### Meansure the difference between noise predicted and realnoise
+                    micro_loss = criterion(predicted_noise.float(), noise) * (latents.shape[0] / l)
+
+                scaler.scale(micro_loss).backward()
+                loss = loss + micro_loss.detach()
+
+            ### One optimizer and EMA step by batch
+            scaler.step(optimizer)
+            scaler.update()
             ema.step_ema(ema_model, diffusion_model)
 
             # train_pbar.update()
@@ -102,39 +154,83 @@ class TrainDiffusion():
                 t = diffusion.sample_timesteps(latents.shape[0]).to(device)
                 x_t, noise = diffusion.noise_images(latents, t)
 
-                ### Predict the noise 
-                predicted_noise = diffusion_model(x_t, t, labels).half()
-
-                with torch.autocast(device_type=device):
-                    val_loss = criterion(predicted_noise, noise)
+                with self.autocast(device):
+                    ### Predict the noise 
+                    predicted_noise = diffusion_model(x_t, t, labels)
+                    val_loss = criterion(predicted_noise.float(), noise)
 
                 # val_pbar.update()
 
         return val_loss, l ,labels
     
-    def train(self, epochs, lr, pretained_name=None):
+    def save_training_state(self, checkpoint_writer, epoch, diffusion_model, optimizer, ema, ema_model, scheduler, scaler, best_loss, best_epoch):
+        """
+        Save in train_state.pt everything needed to continue the training
+        after the epoch (weights, optimizer, EMA, scheduler, scaler and RNGs).
+        """
+        state = {
+            "run_name": run_name,
+            "epoch": epoch,
+            "best_loss": best_loss,
+            "best_epoch": best_epoch,
+            "model": diffusion_model.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "ema_model": ema_model.state_dict(),
+            "ema_step": ema.step,
+            "scheduler": scheduler.state_dict(),
+            "scaler": scaler.state_dict(),
+            "rng": {
+                "torch": torch.get_rng_state(),
+                "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                "numpy": np.random.get_state(),
+                "random": random.getstate(),
+            },
+        }
+        checkpoint_writer.save(state, "train_state.pt")
+
+    def load_training_state(self, filename, diffusion_model, optimizer, ema, ema_model, scheduler, scaler):
+        """
+        Restore a train_state.pt and return the next epoch, the best loss and its epoch.
+        """
+        # The RNG states are not only tensors
+        state = torch.load(filename, map_location="cpu", weights_only=False)
+        diffusion_model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        ema_model.load_state_dict(state["ema_model"])
+        ema.step = state["ema_step"]
+        scheduler.load_state_dict(state["scheduler"])
+        scaler.load_state_dict(state["scaler"])
+
+        ## The RNGs last, so the next epoch draws the same batches, noise and dropout
+        torch.set_rng_state(state["rng"]["torch"])
+        if state["rng"]["cuda"] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state["rng"]["cuda"])
+        np.random.set_state(state["rng"]["numpy"])
+        random.setstate(state["rng"]["random"])
+
+        return state["epoch"] + 1, state["best_loss"], state["best_epoch"]
+
+    def train(self, epochs, lr, pretained_name=None, resume_name=None):
         """
-        Method to train the reverse diffusion model and the prompt
+        Method to train the reverse diffusion model and the prompt,
+        resume_name continues the run from its unet_model/resume_name/train_state.pt
         """
 
         ## Load Dataset
         dataset, val_dataset = self.read_dataset()
 
-        # Load Vit prompt
-        prompt = Vit_neck().to("cuda")
-        prompt.eval()
-
         ### Diffusion process
         diffusion = Diffusion(img_size=image_size//8, device=device, noise_steps=noise_steps)
 
         best_loss = 999
-        diffusion_model = UNet_conditional(c_in=4, c_out=4, time_dim=time_dim, img_size=image_size//8,net_dimension=net_dimension).to(device)
+        best_epoch = None
+        diffusion_model = UNet_conditional(c_in=4, c_out=4, time_dim=time_dim, img_size=image_size//8,net_dimension=net_dimension, device=device, learned_null=self.cond_drop_prob > 0, checkpoint_blocks=checkpoint_blocks, attention_backend=attention_backend).to(device)
 
-        ema = EMA(0.995)
+        ema = EMA(0.995, update_every=ema_update_every)
         ema_model = copy.deepcopy(diffusion_model).eval().requires_grad_(False)
 
         ## Read pretrained weights
-        if pretained_name:
+        if pretained_name and not resume_name:
             resume(diffusion_model, os.path.join("unet_model", pretained_name, "ckpt.pt"))
 
         params_list = diffusion_model.parameters()
@@ -142,146 +238,234 @@ class TrainDiffusion():
         scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=250, gamma=0.1)
 
         ## Train dataloader
-        train_loader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+        train_loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, **ld.loader_kwargs(self.loader_config, pin_memory=False))
 
         ## Validation dataloader
-        val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
+        val_loader = DataLoader(val_dataset, batch_size=self.micro_batch_size or batch_size, shuffle=False, **ld.loader_kwargs(self.loader_config, pin_memory=False))
 
         criterion = self.load_losses()
+        scaler = self.create_scaler(device)
+
+        ## Checkpoints written in background, only the keep_checkpoints last epochs are kept
+        checkpoint_writer = CheckpointWriter(os.path.join("unet_model", run_name), keep_last=keep_checkpoints)
+
+        ## Continue an interrupted run
+        start_epoch = 0
+        if resume_name:
+            start_epoch, best_loss, best_epoch = self.load_training_state(os.path.join("unet_model", resume_name, "train_state.pt"), diffusion_model, optimizer, ema, ema_model, scheduler, scaler)
+            logging.info(f"Resuming {resume_name} at epoch {start_epoch}")
+            if start_epoch >= epochs:
+                logging.info(f"{resume_name} already trained the {epochs} epochs (best loss {best_loss} at epoch {best_epoch})")
+                checkpoint_writer.close()
+                return
+
+        test_loss = best_loss
 
         ### Loop over the epochs
-        epoch_pbar = tqdm(range(epochs), desc="Epochs", leave=True)
-        for epoch in epoch_pbar:
-            logging.info(f"Starting epoch {epoch}:")
-
-            ## Train diffusion model
-            loss, l, labels, latents = self.train_epoch(diffusion, diffusion_model, device, train_loader, criterion, optimizer, ema, ema_model)
-            
-            ## Evaluate diffusion model
-            val_loss, val_l, val_labels = self.valid_epoch(diffusion, diffusion_model, device, val_loader, criterion, epoch)
-
-            ## Update the logger
-            experiment.log_metric("loss", loss)
-
-            epoch_pbar.set_postfix(MSE=loss.item(), MSE_val=val_loss.item(), lr=optimizer.param_groups[0]['lr'],  best_loss=best_loss)
-            # epoch_pbar.reset()
-
-            scheduler.step()
-
-            if loss.item() < best_loss:
-                test_loss = loss.item()
-            elif val_loss.item() < best_loss:
-                test_loss = val_loss.item()
-
-            if test_loss < best_loss:
-
-                ### Create the folder to save the model
-                pos_path_save_models = os.path.join("unet_model", run_name)
-                os.makedirs(pos_path_save_models, exist_ok=True)
-
-                best_loss = test_loss
-                best_epoch = epoch
-                checkpoint(diffusion_model, os.path.join("unet_model", run_name, "best_model.pt"))
-                torch.save(optimizer.state_dict(), os.path.join("unet_model", run_name, f"best_optimizer.pt"))
-
-            if epoch % 10 == 0:
-                # Define the label size
-                l = 5
-                if (labels.shape[0]) < l:
-                    l = (labels.shape[0])
-                if val_l > 5:
-                    val_l = 5
-
-                # Denosing the images
-                x = diffusion.sample(diffusion_model, labels=labels[:l], n=l, in_ch=4, create_img=False).half()
-                x_ema = diffusion.sample(ema_model, labels=labels[:l], n=l, in_ch=4, create_img=False).half()
-                x_val = diffusion.sample(diffusion_model, labels=val_labels[:val_l], n=val_l, in_ch=4, create_img=False).half()
-                
-                ### Creating the Folders
-                pos_path_save = os.path.join("unet_results", run_name)
-                os.makedirs(pos_path_save, exist_ok=True)
-
-                ### Denoising the imagens
-                plot_img = vae.latents_to_pil(x)
-                ema_plot_img = vae.latents_to_pil(x_ema)
-                val_plot_img = vae.latents_to_pil(x_val)
-
-                ## Test if code is in a jupyternotebook, only print if yes
-                if is_notebook():
-                    ## Plot the ground truth
-                    plot_images_2(vae.latents_to_pil(latents[:l]))
-                    ## Plot the colorized version Sc
-                    plot_images_2(plot_img[:l])
-                    ## Plot EMA
-                    plot_images_2(ema_plot_img[:l])
-                    ## Plot Validation
-                    plot_images_2(val_plot_img[:val_l])
-
-                ## Save the Sc and ema img
-                save_images_2(plot_img, os.path.join("unet_results", run_name, f"{epoch}.jpg"))
-                save_images_2(ema_plot_img, os.path.join("unet_results", run_name, f"{epoch}_ema.jpg"))
-
-                ### Save the models
-                torch.save(diffusion_model.state_dict(), os.path.join("unet_model", run_name, f"ckpt.pt"))
-                torch.save(optimizer.state_dict(), os.path.join("unet_model", run_name, f"optimizer.pt"))
-                torch.save(ema_model.state_dict(), os.path.join("unet_model", run_name, f"ema_ckpt.pt"))
-
-                ### Save the best loss info
-                nome_arquivo = f"better_loss.txt"
-                arquivo = open(os.path.join("unet_model", run_name, nome_arquivo), "w")
-                arquivo.write(f"Epoch {epoch} - {best_loss}")
-                arquivo.close()
+        ## The pending checkpoints are written even if the training is interrupted
+        try:
+            epoch_pbar = tqdm(range(start_epoch, epochs), desc="Epochs", leave=True)
+            for epoch in epoch_pbar:
+                logging.info(f"Starting epoch {epoch}:")
+
+                ## Train diffusion model
+                loss, l, labels, latents = self.train_epoch(diffusion, diffusion_model, device, train_loader, criterion, optimizer, ema, ema_model, scaler)
+
+                ## Evaluate diffusion model
+                val_loss, val_l, val_labels = self.valid_epoch(diffusion, diffusion_model, device, val_loader, criterion, epoch)
+
+                ## Update the logger
+                experiment.log_metric("loss", loss)
+
+                epoch_pbar.set_postfix(MSE=loss.item(), MSE_val=val_loss.item(), lr=optimizer.param_groups[0]['lr'],  best_loss=best_loss)
+                # epoch_pbar.reset()
+
+                scheduler.step()
+
+                if loss.item() < best_loss:
+                    test_loss = loss.item()
+                elif val_loss.item() < best_loss:
+                    test_loss = val_loss.item()
+
+                if test_loss < best_loss:
+
+                    best_loss = test_loss
+                    best_epoch = epoch
+                    checkpoint_writer.save(diffusion_model.state_dict(), "best_model.pt")
+                    checkpoint_writer.save(optimizer.state_dict(), "best_optimizer.pt")
+
+                if epoch % 10 == 0:
+                    # Define the label size
+                    l = 5
+                    if (labels.shape[0]) < l:
+                        l = (labels.shape[0])
+                    if val_l > 5:
+                        val_l = 5
+
+                    ## Previews decoded by the fp16 autoencoder, only on GPU
+                    if torch.device(device).type == "cuda":
+                        # Denosing the images
+                        x = diffusion.sample(diffusion_model, labels=labels[:l], n=l, in_ch=4, create_img=False).half()
+                        x_ema = diffusion.sample(ema_model, labels=labels[:l], n=l, in_ch=4, create_img=False).half()
+                        x_val = diffusion.sample(diffusion_model, labels=val_labels[:val_l], n=val_l, in_ch=4, create_img=False).half()
+
+                        ### Creating the Folders
+                        pos_path_save = os.path.join("unet_results", run_name)
+                        os.makedirs(pos_path_save, exist_ok=True)
+
+                        # Decoder of the latents, imported here as it loads the autoencoder in the GPU
+                        import VAE as vae
+
+                        ### Denoising the imagens
+                        plot_img = vae.latents_to_pil(x)
+                        ema_plot_img = vae.latents_to_pil(x_ema)
+                        val_plot_img = vae.latents_to_pil(x_val)
+
+                        ## Test if code is in a jupyternotebook, only print if yes
+                        if is_notebook():
+                            ## Plot the ground truth
+                            plot_images_2(vae.latents_to_pil(latents[:l]))
+                            ## Plot the colorized version Sc
+                            plot_images_2(plot_img[:l])
+                            ## Plot EMA
+                            plot_images_2(ema_plot_img[:l])
+                            ## Plot Validation
+                            plot_images_2(val_plot_img[:val_l])
+
+                        ## Save the Sc and ema img
+                        save_images_2(plot_img, os.path.join("unet_results", run_name, f"{epoch}.jpg"))
+                        save_images_2(ema_plot_img, os.path.join("unet_results", run_name, f"{epoch}_ema.jpg"))
+
+                    ### Save the models (ckpt.pt is the last ckpt_{epoch}.pt)
+                    checkpoint_writer.save(diffusion_model.state_dict(), "ckpt.pt", epoch=epoch)
+                    checkpoint_writer.save(optimizer.state_dict(), "optimizer.pt", epoch=epoch)
+                    checkpoint_writer.save(ema_model.state_dict(), "ema_ckpt.pt", epoch=epoch)
+
+                    ### Save the best loss info
+                    nome_arquivo = f"better_loss.txt"
+                    arquivo = open(os.path.join("unet_model", run_name, nome_arquivo), "w")
+                    arquivo.write(f"Epoch {epoch} - {best_loss}")
+                    arquivo.close()
+
+                ### Resumable state of the training
+                if (epoch + 1) % save_state_every == 0 or epoch == epochs - 1:
+                    self.save_training_state(checkpoint_writer, epoch, diffusion_model, optimizer, ema, ema_model, scheduler, scaler, best_loss, best_epoch)
+        except BaseException:
+            ## A failure of the pending writes must not hide the training error
+            try:
+                checkpoint_writer.close()
+            except Exception as error:
+                logging.error(f"Checkpoint writing failed: {error}")
+            raise
+        checkpoint_writer.close()
 
         torch.cuda.empty_cache()
         experiment.log_metrics({"loss": loss, "best_loss": best_loss, "best_epoch": best_epoch})
 
-if __name__ == "__main__":
+def cpu_test():
+    """
+    Training steps on CPU with a tiny model and random latents, with each
+    precision of the CPU: the loss must be finite and the weights stay in fp32.
+    """
+    device = "cpu"
+    diffusion = Diffusion(img_size=28, device=device, noise_steps=20)
+    batches = [(torch.randn(4, 4, 28, 28), torch.randn(4, 50, 768), None) for _ in range(3)]
+
+    for precision in ("fp32", "bf16"):
+        torch.manual_seed(0)
+        training = TrainDiffusion(None, None, 224, 32, precision=precision, micro_batch_size=2)
+        model = UNet_conditional(c_in=4, c_out=4, time_dim=32, img_size=28, net_dimension=4, device=device)
+        ema_model = copy.deepcopy(model).eval().requires_grad_(False)
+        optimizer = optim.Adam(model.parameters(), lr=1e-4)
+
+        start = time.perf_counter()
+        loss = training.train_epoch(diffusion, model, device, batches, nn.MSELoss(), optimizer, EMA(0.995), ema_model)[0]
+        elapsed = time.perf_counter() - start
+
+        assert torch.isfinite(loss), f"{precision}: loss is {loss.item()}"
+        assert all(param.dtype == torch.float32 for param in model.parameters()), f"{precision}: weights are not fp32"
+        print(f"{precision}: loss {loss.item():.4f}, {1000 * elapsed / len(batches):.1f} ms/step")
 
-    ### Hyperparameters
-    seed = 42
-    torch.manual_seed(seed)
-    model_name = get_model_time()
-    run_name = f"Diffusion_{model_name}"
-    noise_steps = 200
-    time_dim=1000
-    device="cuda"
-    image_size=224
-    net_dimension=100
-    batch_size=100
-    
-    pretained_name = None
-    used_dataset = "LDV"
-    dataroot = f"./diffusion/data/latens/{used_dataset}/"
-    valid_dataroot = f"./diffusion/data/latens/DAVIS_val/"
-    # latent_file_name = "latents_transf.npz"
-    latent_file_name = "latents.npz"
-    early_stop_thresh = 50
-    
-    epochs = 501
-    lr=2e-5
-
-    comet_logger = comet_ml.Experiment(
-    api_key=".",
-    project_name=".",
-    log_code=True)
-
-    experiment = comet_logger
-
-    comet_logger.log_parameters({
-        "batch_size": batch_size,
-        "img_size": image_size,
-        "used_dataset": used_dataset,
-        "coment_logger": "diffusion trainin in latent space",
-        "scheduler": "CosineAnnealingLR",
-        "optimizer": "Adam",
-    })
-
-    # Log all the code files automatically
-    code_files = python_files()
-    for file in code_files:
-        experiment.log_code(file_name=file)
-
-    training = TrainDiffusion(dataroot, valid_dataroot, image_size, time_dim)
-    training.train(epochs, lr, pretained_name)
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", default=None, help="run name to continue from unet_model/<run name>/train_state.pt")
+    parser.add_argument("--cpu_test", action="store_true", help="tiny training steps on CPU with fp32 and bf16")
+    args, unknown = parser.parse_known_args()
+
+    if args.cpu_test:
+        cpu_test()
+    else:
+        ### Hyperparameters
+        seed = 42
+        torch.manual_seed(seed)
+        model_name = get_model_time()
+        run_name = f"Diffusion_{model_name}"
+        # A resumed run keeps writing in its folder
+        if args.resume:
+            run_name = args.resume
+        noise_steps = 200
+        time_dim=1000
+        device="cuda"
+        image_size=224
+        net_dimension=100
+        batch_size=100
+        # Micro batch of each forward/backward (None uses the whole batch), the batch size is unchanged
+        micro_batch_size = None
+        # Blocks of the UNet with activation checkpointing, e.g. ("sa1", "sa5", "sa6") (see python benchmark.py checkpointing)
+        checkpoint_blocks = ()
+        # SelfAttention backend: "mha", "sdpa", "chunked" or "window" (see python benchmark.py attention)
+        attention_backend = "mha"
+        # Epochs of checkpoints (ckpt, optimizer and ema_ckpt) kept on disk
+        keep_checkpoints = 3
+        # Epochs between two saves of the resumable train_state.pt
+        save_state_every = 1
+
+        pretained_name = None
+        used_dataset = "LDV"
+        dataroot = f"./diffusion/data/latens/{used_dataset}/"
+        valid_dataroot = f"./diffusion/data/latens/DAVIS_val/"
+        # latent_file_name = "latents_transf.npz"
+        latent_file_name = "latents.npz"
+        early_stop_thresh = 50
+        cond_drop_prob = 0.1
+        # "fp32", "bf16", "fp16" or "auto" (bf16 on CPU, fp16 with loss scaling on GPU)
+        precision = "auto"
+        # Optimizer steps between two EMA updates
+        ema_update_every = 1
+        # Json of "python benchmark.py dataloader" (None loads in the main process)
+        loader_config = None
+
+        epochs = 501
+        lr=2e-5
+
+        # Logger
+        import comet_ml
+        comet_logger = comet_ml.Experiment(
+        api_key=".",
+        project_name=".",
+        log_code=True)
+
+        experiment = comet_logger
+
+        comet_logger.log_parameters({
+            "batch_size": batch_size,
+            "micro_batch_size": micro_batch_size,
+            "img_size": image_size,
+            "used_dataset": used_dataset,
+            "coment_logger": "diffusion trainin in latent space",
+            "scheduler": "CosineAnnealingLR",
+            "optimizer": "Adam",
+            "cond_drop_prob": cond_drop_prob,
+            "precision": precision,
+        })
+
+        # Log all the code files automatically
+        code_files = python_files()
+        for file in code_files:
+            experiment.log_code(file_name=file)
+
+        training = TrainDiffusion(dataroot, valid_dataroot, image_size, time_dim, cond_drop_prob=cond_drop_prob, loader_config=loader_config, precision=precision, micro_batch_size=micro_batch_size)
+        training.train(epochs, lr, pretained_name, resume_name=args.resume)
 
     print("Done")
@@ -1,4 +1,7 @@
 import os
+import shutil
+import threading
+from collections import OrderedDict
 import torch
 import torchvision
 from PIL import Image
@@ -137,7 +140,7 @@ def read_frames(image_folder, img_start_name=None):
         if images == []:
             images = [img for img in os.listdir(image_folder) if img.endswith(".jpg")]
 
-    return images
+    return sorted(images)
 
 def frame_2_video(image_folder, video_name, img_start_name, gray=False, frame_rate=16):
     """
@@ -246,6 +249,138 @@ def resume(model, filename):
 def checkpoint(model, filename):
     torch.save(model.state_dict(), filename)
 
+def to_cpu(state):
+    """
+    Copy of the tensors of a (nested) state dict in the CPU.
+    """
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        copy = type(state)((key, to_cpu(value)) for key, value in state.items())
+        # Versions of the modules of a state_dict, used by load_state_dict
+        if hasattr(state, "_metadata"):
+            copy._metadata = state._metadata
+        return copy
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+    return state
+
+class CheckpointWriter():
+    """
+    Save checkpoints in folder with a background thread. save() copies the state
+    to the CPU and returns, the thread writes it in a temporary file renamed to
+    the final name (a crash never leaves a partial checkpoint). A pending save is
+    replaced by a newer one of the same file. The files saved with an epoch are
+    named {name}_{epoch}.pt, the last one is also {name}.pt and only the
+    keep_last newest are kept, the others (e.g. best_model.pt) are overwritten.
+    """
+
+    def __init__(self, folder, keep_last=3) -> None:
+        self.folder = folder
+        self.keep_last = keep_last
+        os.makedirs(folder, exist_ok=True)
+
+        # Path -> (state, name of the latest copy), in order of arrival
+        self.pending = OrderedDict()
+        self.epoch_files = {}
+        self.writing = False
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, file_name, epoch=None):
+        self.check_error()
+        state = to_cpu(state)
+        latest = None
+        if epoch is not None:
+            name, ext = os.path.splitext(file_name)
+            latest, file_name = file_name, f"{name}_{epoch}{ext}"
+
+        with self.condition:
+            self.pending[os.path.join(self.folder, file_name)] = (state, latest)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                path, (state, latest) = self.pending.popitem(last=False)
+                self.writing = True
+            try:
+                self.write(path, state, latest)
+            except Exception as error:
+                self.error = error
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def write(self, path, state, latest):
+        temp_path = f"{path}.tmp"
+        torch.save(state, temp_path)
+        os.replace(temp_path, path)
+        if latest is None:
+            return
+
+        ## The latest copy is a hard link of the epoch file (a copy if not supported)
+        latest_path = os.path.join(self.folder, latest)
+        temp_path = f"{latest_path}.tmp"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        try:
+            os.link(path, temp_path)
+        except OSError:
+            shutil.copyfile(path, temp_path)
+        os.replace(temp_path, latest_path)
+
+        ## Retention of the epoch files (with the ones of a resumed run)
+        if latest not in self.epoch_files:
+            self.epoch_files[latest] = self.saved_epoch_files(latest)
+        files = self.epoch_files[latest]
+        if path not in files:
+            files.append(path)
+        while len(files) > self.keep_last:
+            old_path = files.pop(0)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def saved_epoch_files(self, latest):
+        """
+        Files {name}_{epoch}.pt of latest already in the folder, by epoch.
+        """
+        name, ext = os.path.splitext(latest)
+        epochs = []
+        for file_name in os.listdir(self.folder):
+            epoch = file_name[len(name) + 1:-len(ext)] if file_name.startswith(f"{name}_") and file_name.endswith(ext) else ""
+            if epoch.isdigit():
+                epochs.append(int(epoch))
+        return [os.path.join(self.folder, f"{name}_{epoch}{ext}") for epoch in sorted(epochs)]
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Checkpoint writing failed") from error
+
+    def flush(self):
+        """
+        Wait until every pending checkpoint is written.
+        """
+        with self.condition:
+            while self.pending or self.writing:
+                self.condition.wait()
+        self.check_error()
+
+    def close(self):
+        self.flush()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
 def weights_regularization(model, loss):
     """"
     Recives a model and loss of the acutal training epoch, and
@@ -14,9 +14,9 @@ from modules import *
 from ddpm import *
 from utils import *
 import VAE as vae
-from ViT import Vit_neck
+from ViT import Vit_neck, VitCache
+from video_pipeline import colorize_videos
 
-import shutil
 # ================ Initial Infos =====================
 import argparse
 model_name = get_model_time()
@@ -33,6 +33,24 @@ args.in_ch=256
 args.out_ch = 256
 args.net_dimension=200
 
+## Reverse process ("ddpm", "ddim" or "dpmpp2m"), few steps are much faster than the full ddpm chain
+args.sampler = "dpmpp2m"
+args.sampling_steps = 15
+args.eta = 0.
+## Classifier free guidance (needs a model trained with cond_drop_prob > 0, learned_null=True)
+args.cfg_scale = 0
+args.learned_null = False
+## Warm start each frame from the previous colorized frame (fallback to the full chain on scene cuts)
+args.warm_start = False
+args.warm_strength = 0.5
+args.cut_threshold = 0.9
+## Early exit of the samples whose predicted clean latent converged (None runs every step)
+args.early_exit_tol = None
+## Disk cache of the ViT features, shared by runs and models (None disables it)
+args.vit_cache_dir = "data/vit_cache"
+## SelfAttention backend ("mha", "sdpa", "chunked" or "window"), the weights are the same
+args.attention_backend = "sdpa"
+
 # dataset = "mini_kinetics"
 dataset = "DAVIS_test"
 data_mode = "test"
@@ -48,10 +66,6 @@ img_classes = os.listdir(images_paths)
 
 # ================ Read Video =====================
 
-# Temp folder to save the video frames (delete after process)
-temp_path = f"temp/{dataset}/"
-os.makedirs(temp_path, exist_ok=True)
-
 # Path where is the gray version of videos
 path_gray_video = f"./data/videos/{dataset}_gray/"
 try:
@@ -63,7 +77,7 @@ except FileNotFoundError:
 
 
 # ================ Read Model =====================
-root_model_path = ".\diffusion\unet_model"
+root_model_path = r".\diffusion\unet_model"
 # date_str = "UNET_20230404_120711"
 
 
@@ -83,7 +97,7 @@ root_model_path = ".\diffusion\unet_model"
 
 ### Diffusion process
 diffusion = Diffusion(img_size=args.image_size//8, device=device, noise_steps=args.noise_steps)
-diffusion_model = UNet_conditional(c_in=4, c_out=4, time_dim=args.time_dim, img_size=args.image_size//8,net_dimension=args.net_dimension).to(device)
+diffusion_model = UNet_conditional(c_in=4, c_out=4, time_dim=args.time_dim, img_size=args.image_size//8,net_dimension=args.net_dimension, learned_null=args.learned_null, attention_backend=args.attention_backend).to(device)
 if best_model:
     diffusion_model = load_trained_weights(diffusion_model, date_str, "best_model")
 else:
@@ -94,82 +108,62 @@ diffusion_model.eval()
 # ### Labels generation
 prompt = Vit_neck().to("cuda")
 prompt.eval()
+if args.vit_cache_dir:
+    prompt = VitCache(prompt, args.vit_cache_dir)
 
-# ================ Loop all videos inside gray folder =====================
-pbar = tqdm(list_gray_videos)
-for video_name in pbar:
-    #Count for frames in video
-    count_frame_idx=0
-    pbar.set_description(f"Processing: {video_name}")
-
-    vidcap = cv2.VideoCapture(f"{path_gray_video}{video_name}")
-    success,image = vidcap.read()
-    count = 0
-    list_frames = []
-
-    path_temp_gray_frames = f"{temp_path}{video_name.split('.')[0]}"
-    if not os.path.exists(path_temp_gray_frames):
-
-        os.makedirs(f"{path_temp_gray_frames}/images/", exist_ok=True)
-
-        while success:
-            cv2.imwrite(f"{path_temp_gray_frames}/images/{str(count).zfill(5)}.jpg", image)     # save frame as JPEG file      
-            success,image = vidcap.read()
-            list_frames.append(image)
-            count += 1
-
-    # ================ Read images to make the video =====================
-    dataLoader = ld.ReadData()
-    dataloader = dataLoader.create_dataLoader(path_temp_gray_frames, args.image_size, batch_size, pin_memory=False)
-
-    # ============== Frame Production ===================
-    imgs_2 = []
-    imgs_2_gray = []
-
-    outs = []
-    # path to save colored frames
-    colored_frames_save = f"temp_result/{dataset}/{date_str}/{video_name}/"
-
-    if os.path.exists(colored_frames_save):
-        shutil.rmtree(colored_frames_save)
-
-    os.makedirs(colored_frames_save, exist_ok=True)
-
+# ================ Paths of the colorized videos =====================
+video_paths = []
+output_paths = []
+for video_name in list_gray_videos:
     # path so save videos
     colored_video_path = f"videos_output/{date_str}/{video_name}/"
     os.makedirs(colored_video_path, exist_ok=True)
 
-    img_count = 0
-    with torch.no_grad():
-
-        # pbar = tqdm(dataloader)
-        for i, (data) in enumerate(dataloader):
-            # Set the imagens from dataloader
-            img, img_gray, img_color, _ = create_samples(data)            
-            #### Images
-
-            ## Gray Image
-            input_img = img_gray.to(device)
-            l = input_img.shape[0]
+    video_paths.append(f"{path_gray_video}{video_name}")
+    output_paths.append(f"{colored_video_path}/{video_name}_colored.mp4")
 
-            ## Labels to create sample from noise
-            labels = prompt(input_img)
+# ============== Frame Production ===================
+# Last colorized latent of each video (warm start)
+prev_frames = {}
+# Model evaluations of each frame (telemetry of the early exit)
+frame_steps = []
 
-            ### Diffusion (due the noise version of input and predict)
-            x = diffusion.sample(diffusion_model, labels=labels, n=l, in_ch=4, create_img=False).half()
-
-            ### Decoder the output of diffusion
-            sampled_images = vae.latents_to_pil(x)
-
-            for img_idx in range(len(sampled_images)):
-                if args.rgb:
-                    save_images((sampled_images[img_idx]), os.path.join(colored_frames_save,  f"{str(count_frame_idx).zfill(5)}.jpg"))
-                else:
-                    save_images(tensor_lab_2_rgb(sampled_images[img_idx].unsqueeze(0)), os.path.join(colored_frames_save,  f"{str(count_frame_idx).zfill(5)}.jpg"))
-                count_frame_idx+=1
-            
-            torch.cuda.empty_cache()
-
-    frame_2_video(colored_frames_save, f"{colored_video_path}/{video_name}_colored.mp4", img_start_name=None)
-
-print("Evaluation Finish")
\ No newline at end of file
+def colorize_batch(img, video_idx):
+    """
+    Colorize a batch of frames pooled from the videos (see colorize_videos).
+    """
+    with torch.no_grad():
+        ## Gray Image
+        input_img = transforms.Grayscale(num_output_channels=3)(img).to(device)
+        l = input_img.shape[0]
+
+        ## Labels to create sample from noise
+        labels = prompt(input_img)
+
+        ### Diffusion (due the noise version of input and predict)
+        if args.warm_start:
+            ## Chain the frames of each video, the frames of the videos are denoised together
+            x = diffusion.sample_video(diffusion_model, labels, video_idx=video_idx, prev_frames=prev_frames, strength=args.warm_strength, cut_threshold=args.cut_threshold,
+                                       in_ch=4, sampler=args.sampler, steps=args.sampling_steps, eta=args.eta, cfg_scale=args.cfg_scale).half()
+        else:
+            x, n_steps = diffusion.sample(diffusion_model, labels=labels, n=l, in_ch=4, create_img=False, sampler=args.sampler, steps=args.sampling_steps, eta=args.eta,
+                                          cfg_scale=args.cfg_scale, tol=args.early_exit_tol, return_steps=True)
+            x = x.half()
+            frame_steps.extend(n_steps.tolist())
+
+        ### Decoder the output of diffusion
+        sampled_images = vae.latents_to_pil(x)
+
+    return sampled_images
+
+# ============== Streaming: decode -> colorize -> encode ===================
+## With warm start the frames of a round come from different videos, decode them round-robin
+interleave = batch_size if args.warm_start else 0
+colorize_videos(video_paths, output_paths, colorize_batch, image_size=args.image_size, batch_size=batch_size, interleave=interleave)
+
+if frame_steps:
+    print(f"Mean model evaluations per frame: {sum(frame_steps) / len(frame_steps)}")
+if args.vit_cache_dir:
+    print(f"ViT cache: {prompt.stats()}")
+
+print("Evaluation Finish")
@@ -0,0 +1,239 @@
+"""
+Helpers to colorize many videos at once. The frames are decoded straight
+from cv2.VideoCapture by a thread, pooled in full batches of all the videos
+for the model and the results are routed back to their video, where an
+other thread encodes them with cv2.VideoWriter. The stages are connected by
+bounded queues, so no frame is written to disk.
+"""
+import queue
+import threading
+
+import cv2
+import numpy as np
+import torch
+from torchvision.transforms import functional as TF
+from tqdm import tqdm
+
+# Marks the end of the stream in the queues
+END = None
+
+class FrameRouter():
+    """
+    Route the colorized frames of pooled batches back to their video.
+    The frames of each video are released to write_frame(video, frame_idx, frame)
+    in frame order, and close_video(video) is called after the last frame
+    of the video was written. When the lengths of the videos are not known
+    up front they are given with end_video.
+    """
+
+    def __init__(self, video_lengths, write_frame, close_video=None) -> None:
+        # Total of frames of each video
+        self.video_lengths = dict(video_lengths)
+        self.write_frame = write_frame
+        self.close_video = close_video
+
+        # Frames that arrived before the previous ones of the same video
+        self.pending = {}
+        # Next frame to be written of each video
+        self.next_frame = {}
+        # Videos already closed
+        self.closed = set()
+
+    def put(self, videos, frame_idxs, frames):
+        """
+        Receive a batch of frames, with the video and frame index of each one.
+        """
+        for video, frame_idx, frame in zip(videos, frame_idxs, frames):
+            pending = self.pending.setdefault(video, {})
+            pending[frame_idx] = frame
+
+            next_frame = self.next_frame.get(video, 0)
+            while next_frame in pending:
+                self.write_frame(video, next_frame, pending.pop(next_frame))
+                next_frame += 1
+            self.next_frame[video] = next_frame
+
+            self._try_close(video)
+
+    def end_video(self, video, length):
+        """
+        Set the number of frames of a video.
+        """
+        self.video_lengths[video] = length
+        self._try_close(video)
+
+    def _try_close(self, video):
+        if video in self.closed or self.next_frame.get(video, 0) != self.video_lengths.get(video):
+            return
+        self.closed.add(video)
+        self.pending.pop(video, None)
+        if self.close_video is not None:
+            self.close_video(video)
+
+
+def frame_to_tensor(frame, image_size):
+    """
+    Convert a BGR frame of cv2 to a normalized RGB tensor of image_size,
+    as the ColorizationDataset transform without augmentation.
+    """
+    x = torch.from_numpy(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)).permute(2, 0, 1)
+    x = TF.resize(x, [image_size, image_size], antialias=True)
+    return (x.float() / 255 - 0.5) / 0.5
+
+
+def decode_videos(video_paths, image_size, out_queue, fps, stop=None, interleave=0):
+    """
+    Decode the videos in order and put (video_idx, frame_idx, frame) in out_queue,
+    after the frames of a video (video_idx, END, number of frames) and at the end
+    of all videos END. The frame rate of each video is saved in fps.
+    interleave: number of videos decoded round-robin (one frame of each in turn),
+    so a batch holds the same frame of many videos; 0 decodes one video at a time.
+    The decoding ends early when the stop event is set.
+    """
+    if stop is None:
+        stop = threading.Event()
+    pending = iter(enumerate(video_paths))
+    # Open videos as [video_idx, capture, number of decoded frames]
+    active = []
+
+    def open_next():
+        for video_idx, path in pending:
+            vidcap = cv2.VideoCapture(path)
+            fps[video_idx] = vidcap.get(cv2.CAP_PROP_FPS) or 16
+            active.append([video_idx, vidcap, 0])
+            return
+
+    try:
+        for _ in range(max(interleave, 1)):
+            open_next()
+        while active and not stop.is_set():
+            for video in list(active):
+                video_idx, vidcap, frame_idx = video
+                # Without interleave the whole video is read before the next one
+                while not stop.is_set():
+                    success, image = vidcap.read()
+                    if not success:
+                        vidcap.release()
+                        active.remove(video)
+                        out_queue.put((video_idx, END, frame_idx))
+                        open_next()
+                        break
+                    out_queue.put((video_idx, frame_idx, frame_to_tensor(image, image_size)))
+                    frame_idx += 1
+                    video[2] = frame_idx
+                    if interleave:
+                        break
+    finally:
+        for _, vidcap, _ in active:
+            vidcap.release()
+        out_queue.put(END)
+
+
+def encode_videos(output_paths, in_queue, fps, errors):
+    """
+    Write the frames received from in_queue as (video_idx, frame) (RGB uint8 arrays,
+    in frame order) in the video output_paths[video_idx]. (video_idx, END) closes
+    the video and END stops the thread.
+    """
+    fourcc = cv2.VideoWriter_fourcc(*'MP4V')
+    writers = {}
+    try:
+        while True:
+            item = in_queue.get()
+            if item is END:
+                break
+            video_idx, frame = item
+            if frame is END:
+                # A video without frames (unreadable file) has no writer
+                writer = writers.pop(video_idx, None)
+                if writer is not None:
+                    writer.release()
+                continue
+            frame = cv2.cvtColor(np.asarray(frame), cv2.COLOR_RGB2BGR)
+            if video_idx not in writers:
+                height, width = frame.shape[:2]
+                writers[video_idx] = cv2.VideoWriter(output_paths[video_idx], fourcc, fps[video_idx], (width, height))
+            writers[video_idx].write(frame)
+    except Exception as e:
+        errors.append(e)
+        # Keep consuming so the producer never blocks on a full queue
+        while in_queue.get() is not END:
+            pass
+    finally:
+        for writer in writers.values():
+            writer.release()
+
+
+def colorize_videos(video_paths, output_paths, colorize_batch, image_size=224, batch_size=50, queue_size=None, interleave=0):
+    """
+    Colorize the videos video_paths into output_paths with a streaming pipeline.
+    colorize_batch(frames, video_idx) receive a batch of normalized frames pooled
+    from the videos (with the index of the video of each frame, the frames of a
+    video are in order) and return the colorized frames as RGB uint8 images.
+    queue_size: bound of the decoded and encoded queues (default 2 batches).
+    interleave: number of videos decoded round-robin (see decode_videos), each
+    one keeps a video writer open.
+    """
+    if queue_size is None:
+        queue_size = 2 * batch_size
+
+    decoded = queue.Queue(maxsize=queue_size)
+    encoded = queue.Queue(maxsize=queue_size)
+    fps = {}
+    errors = []
+    stop = threading.Event()
+
+    decoder = threading.Thread(target=decode_videos, args=(video_paths, image_size, decoded, fps, stop, interleave), daemon=True)
+    encoder = threading.Thread(target=encode_videos, args=(output_paths, encoded, fps, errors), daemon=True)
+    decoder.start()
+    encoder.start()
+
+    router = FrameRouter({}, lambda video, frame_idx, frame: encoded.put((video, frame)), lambda video: encoded.put((video, END)))
+
+    def run_batch(batch):
+        video_idx = torch.tensor([item[0] for item in batch])
+        frames = torch.stack([item[2] for item in batch])
+        router.put(video_idx.tolist(), [item[1] for item in batch], colorize_batch(frames, video_idx))
+
+    batch = []
+    pbar = tqdm(desc="Colorizing frames", unit="frame")
+    try:
+        while True:
+            item = decoded.get()
+            if item is END:
+                break
+            video_idx, frame_idx, frame = item
+            if frame_idx is END:
+                # The video ends, the frames still in the batch are routed later
+                router.end_video(video_idx, frame)
+                continue
+
+            batch.append(item)
+            if len(batch) == batch_size:
+                run_batch(batch)
+                pbar.update(len(batch))
+                batch = []
+
+            # Stop as soon as the encoder fails
+            if errors:
+                break
+
+        if batch and not errors:
+            run_batch(batch)
+            pbar.update(len(batch))
+    finally:
+        pbar.close()
+        ## Stop the decoder and empty its queue, it may be blocked on a full
+        ## queue if the colorization failed
+        stop.set()
+        while decoder.is_alive():
+            try:
+                decoded.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        decoder.join()
+        encoded.put(END)
+        encoder.join()
+
+    if errors:
+        raise errors[0]